@@ -0,0 +1,197 @@
+"""Generate the mbox files benchmarks upload.
+
+Each corpus is made from a seeded random generator, so that a given scale
+always gives the same bytes. scale multiplies the number of messages.
+"""
+
+import base64
+import bz2
+import email.utils
+import gzip
+import lzma
+import os
+import random
+import shutil
+import time
+
+SENDERS = ["Alice <alice@example.com>", "Bob <bob@example.net>", "Carol <carol@example.org>",
+           "Dan =?utf-8?q?M=C3=BCller?= <dan@example.de>"]
+WORDS = ("the of and to in is that for it as with was on be by at this from or have "
+         "caf\xe9 na\xefve r\xe9sum\xe9 \xfcber stra\xdfe").split()
+LABELS = ["Inbox", "Sent", "Important", "Unread", "Opened", "Work", "Work/Projects",
+          "Family", "Travel", "Receipts", "Category Updates", "Category Promotions"]
+
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for i in range(n))
+
+
+def headers(rng, i, extra=(), subject=None):
+    when = 1230944734 + i * 3607
+    lines = ["From %s %s" % (rng.choice(SENDERS).split("<")[1][:-1], time.asctime(time.gmtime(when))),
+             "Message-ID: <%d.%d@bench.example>" % (i, rng.getrandbits(32)),
+             "Date: %s" % email.utils.formatdate(when),
+             "From: %s" % rng.choice(SENDERS),
+             "To: someone@example.com",
+             "Subject: %s" % (words(rng, 6) if subject is None else subject)]
+    lines.extend(extra)
+    return "\n".join(lines).encode("utf-8") + b"\n"
+
+
+def body(rng, lines):
+    return ("\n".join(words(rng, 12) for i in range(lines)) + "\n").encode("utf-8")
+
+
+def tiny(path, scale=1.0, seed=1):
+    """Many small text messages, a few hundred bytes to a few kB each."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        for i in range(int(5000 * scale)):
+            f.write(headers(rng, i, ["Content-Type: text/plain; charset=utf-8",
+                                     "Content-Transfer-Encoding: 8bit"]))
+            f.write(b"\n" + body(rng, rng.randint(2, 40)) + b"\n")
+    return path
+
+
+def attachment_message(f, rng, i, size):
+    """Write a message with an attachment of about size bytes to f."""
+    f.write(headers(rng, i, ["MIME-Version: 1.0",
+                             'Content-Type: multipart/mixed; boundary="b%d"' % i]))
+    f.write(b"\n--b%d\nContent-Type: text/plain; charset=utf-8\n\n" % i)
+    f.write(body(rng, 10))
+    f.write(b"--b%d\nContent-Type: application/octet-stream\n"
+            b"Content-Transfer-Encoding: base64\n\n" % i)
+    attachment = base64.encodebytes(rng.randbytes(size * 3 // 4))
+    f.write(attachment)
+    f.write(b"--b%d--\n\n" % i)
+
+
+def huge(path, scale=1.0, seed=2, size=16 * 1024 * 1024):
+    """A few messages with an attachment of about size bytes each."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        for i in range(max(1, int(5 * scale))):
+            attachment_message(f, rng, i, size)
+    return path
+
+
+def mixed(path, scale=1.0, seed=5):
+    """Small text messages with a large one, of 2 to 12 MB, every 100 or so."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        for i in range(int(3000 * scale)):
+            if rng.random() < 0.01:
+                attachment_message(f, rng, i, rng.randint(2, 12) * 1024 * 1024)
+                continue
+            f.write(headers(rng, i))
+            f.write(b"\n" + body(rng, rng.randint(2, 40)) + b"\n")
+    return path
+
+
+def large_first(path, scale=1.0, seed=8, size=24 * 1024 * 1024):
+    """A message with an attachment of about size bytes, then small text messages."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        attachment_message(f, rng, 0, size)
+        for i in range(1, int(2000 * scale)):
+            f.write(headers(rng, i))
+            f.write(b"\n" + body(rng, rng.randint(2, 40)) + b"\n")
+    return path
+
+
+def takeout(path, scale=1.0, seed=3):
+    """Messages of a Google Takeout export, with one to four labels each."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        for i in range(int(2000 * scale)):
+            labels = rng.sample(LABELS, rng.randint(1, 4))
+            f.write(headers(rng, i, ["X-GM-THRID: %d" % rng.getrandbits(60),
+                                     "X-Gmail-Labels: " + ",".join(labels)]))
+            f.write(b"\n" + body(rng, rng.randint(2, 60)) + b"\n")
+    return path
+
+
+def tree(path, scale=1.0, seed=4):
+    """A Thunderbird-like tree of folders holding many small mbox files.
+
+    path is the folder made for it; the sizes of the mbox files vary a lot,
+    so that the order they are uploaded in matters.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path)
+    i = 0
+    for n in range(max(2, int(200 * scale))):
+        folder = os.path.join(path, *("f%d" % rng.randrange(8) for depth in range(rng.randrange(3))))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "box%d.mbox" % n), "wb") as f:
+            for j in range(int(rng.paretovariate(1.2) * 5)):
+                f.write(headers(rng, i))
+                f.write(b"\n" + body(rng, rng.randint(2, 40)) + b"\n")
+                i += 1
+    return path
+
+
+def giant(path, scale=1.0, seed=6):
+    """About scale gigabytes of small messages and a message of 64 to 512 MB every 500 MB or so.
+
+    The attachments of the large messages repeat a block of random data,
+    so that they are written quickly and without holding them in memory.
+    """
+    rng = random.Random(seed)
+    block = base64.encodebytes(rng.randbytes(768 * 1024))
+    size = int(scale * 1e9)
+    i = 0
+    with open(path, "wb") as f:
+        while f.tell() < size:
+            i += 1
+            if rng.random() < 0.0002:
+                f.write(headers(rng, i, ["MIME-Version: 1.0",
+                                         'Content-Type: multipart/mixed; boundary="b%d"' % i]))
+                f.write(b"\n--b%d\nContent-Type: text/plain; charset=utf-8\n\n" % i)
+                f.write(body(rng, 10))
+                f.write(b"--b%d\nContent-Type: application/octet-stream\n"
+                        b"Content-Transfer-Encoding: base64\n\n" % i)
+                for n in range(rng.randint(64, 512)):
+                    f.write(block)
+                f.write(b"--b%d--\n\n" % i)
+                continue
+            f.write(headers(rng, i))
+            f.write(b"\n" + body(rng, rng.randint(2, 400)) + b"\n")
+    return path
+
+
+def faulty(path, scale=1.0, seed=7):
+    """Small text messages, with a run of two or three that cannot be decoded every 50 or so.
+
+    The Subject of those is in a charset Python does not know, so that
+    they fail before being sent, while messages around them are batched.
+    """
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        i = 0
+        while i < int(2000 * scale):
+            bad = rng.random() < 0.02
+            for n in range(rng.randint(2, 3) if bad else 1):
+                i += 1
+                f.write(headers(rng, i, subject="=?x-bogus?Q?abc?=" if bad else None))
+                f.write(b"\n" + body(rng, rng.randint(2, 40)) + b"\n")
+    return path
+
+
+def compressed(corpus, suffix):
+    """Return corpus compressed as a mbox file with suffix .gz, .bz2 or .xz tells."""
+    opener = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}[suffix]
+
+    def generate(path, scale=1.0):
+        corpus(path, scale)
+        with open(path, "rb") as src, opener(path + suffix, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(path)
+        return path + suffix
+    return generate
+
+
+CORPORA = {"tiny": tiny, "huge": huge, "mixed": mixed, "takeout": takeout, "tree": tree, "giant": giant,
+           "faulty": faulty, "large-first": large_first,
+           "tiny-gz": compressed(tiny, ".gz"), "tiny-xz": compressed(tiny, ".xz"), "huge-gz": compressed(huge, ".gz"),
+           "takeout-gz": compressed(takeout, ".gz")}
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Compare the delivery time extraction with the email.utils based one.
+
+Times RawMessage.get_delivery_time() and the email.utils parsing it falls
+back to, field by field as it used to, on generated messages. Their dates
+are in the usual forms and a few others, some repeated as in real mboxes.
+Exits with status 1 if the two ever give a different time; all the fields
+of the messages have a valid date, so that the current time never is.
+
+    python benchmarks/delivery_time.py [--messages N] [--fields LIST]
+"""
+
+import email.utils
+import gc
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import imap_upload
+
+DATE_FORMS = [
+    lambda t: email.utils.formatdate(t),
+    lambda t: email.utils.formatdate(t, localtime=True),
+    lambda t: email.utils.formatdate(t) + " (UTC)",
+    lambda t: time.strftime("%d %b %Y %H:%M:%S GMT", time.gmtime(t)),
+]
+# Less usual forms, left to email.utils, found in a few messages only.
+UNUSUAL_DATE_FORMS = [
+    lambda t: time.strftime("%A, %d-%b-%y %H:%M:%S EST", time.gmtime(t)),
+    lambda t: time.strftime("%a, %d %B %Y %H:%M:%S +0000", time.gmtime(t)),
+]
+
+
+def messages(n, seed=7):
+    """Return n RawMessage objects with From_ lines and Date: and Received: fields."""
+    rng = random.Random(seed)
+
+    def date(t):
+        return rng.choice(UNUSUAL_DATE_FORMS if rng.random() < 0.05 else DATE_FORMS)(t)
+
+    result = []
+    for i in range(n):
+        # Mail lists often bring several messages sent the same second.
+        when = 1230944734 + (i - i % rng.choice((1, 1, 3))) * 3607
+        header = ("Received: from mx.example.com by mail.example.net; %s\n"
+                  "Date: %s\nSubject: message %d\n\n" % (date(when + 60), date(when), i))
+        from_line = "From someone@example.com %s" % time.asctime(time.gmtime(when))
+        result.append(imap_upload.RawMessage(from_line.encode("ascii"), header.encode("ascii")))
+    return result
+
+
+def email_utils_time(msg, fields):
+    """The delivery time of msg as it was found before the fast parsers."""
+    for field in fields:
+        t = imap_upload.parse_time_field(msg, field)
+        if t is not None and t >= 0:
+            return t
+    return None
+
+
+def fast_time(msg, fields):
+    return msg.get_delivery_time(fields)
+
+
+def timed(fn, n, fields):
+    """Return the time fn takes for the delivery time of n new messages, and the times."""
+    # RawMessage keeps the header fields it parsed: each run needs its own.
+    msgs = messages(n)
+    for msg in msgs:
+        # Progress.begin() reads the subject first, which finds the header.
+        msg["subject"]
+    # The garbage collector would otherwise go through the messages a few times.
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        times = [fn(msg, fields) for msg in msgs]
+        return time.perf_counter() - started, times
+    finally:
+        gc.enable()
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--messages", type="int", default=50000,
+                      help="number of messages [default: %default]")
+    parser.add_option("--fields", action="append", metavar="LIST",
+                      help="time fields to try, as for --time-fields; may be "
+                           "repeated [default: from,received,date; date; received]")
+    options, args = parser.parse_args(args)
+    field_lists = [fields.split(",") for fields in options.fields or ["from,received,date", "date", "received"]]
+
+    ok = True
+    for fields in field_lists:
+        imap_upload.parse_from_time.cache_clear()
+        imap_upload.parse_date_time.cache_clear()
+        slow, expected = timed(email_utils_time, options.messages, fields)
+        fast, got = timed(fast_time, options.messages, fields)
+        ok = ok and got == expected
+        print("%-20s email.utils %6.2f us/msg  fast %6.2f us/msg  x%.1f  %s" %
+              (",".join(fields), slow / options.messages * 1e6, fast / options.messages * 1e6, slow / fast,
+               "same times" if got == expected else "DIFFERENT TIMES"))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+"""A local IMAP server standing in for the real ones in benchmarks.
+
+It keeps the mail boxes in memory and implements what imap_upload uses:
+CAPABILITY, LOGIN, LOGOUT, NOOP, CREATE, LIST, SELECT, EXAMINE, APPEND
+(with MULTIAPPEND and non-synchronizing literals), COMPRESS DEFLATE and
+UID COPY, SEARCH and FETCH. It does not check much: it is meant to be fast
+and predictable, not to catch protocol errors.
+
+Real servers are slower and less reliable than that. FakeIMAPServer can
+delay each response, cap the rate at which it reads from the client, fail
+or drop a share of the APPENDs, refuse the messages above a size and
+throttle the clients storing too much at once.
+"""
+
+import collections
+import queue
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+import imap_upload
+
+append_re = re.compile(rb'("(?:[^"\\]|\\.)*"|\S+) (.*)$')
+literal_re = re.compile(rb'(?:(\([^)]*\)) ?)?(?:("[^"]*") ?)?\{(\d+)(\+?)\}$')
+uid_range_re = re.compile(rb"(\d+)(?::(\d+|\*))?")
+fetch_fields_re = re.compile(rb"HEADER\.FIELDS \(([^)]*)\)")
+
+
+def unquote(name):
+    name = name.decode("ascii", "replace")
+    if name[:1] == '"':
+        name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return name
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Serve one IMAP connection."""
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selected = None
+        self.read_started = time.perf_counter()
+        self.read_bytes = 0
+        # Responses are written by another thread once their latency has
+        # passed, so that pipelined commands are not delayed one by one.
+        self.responses = queue.Queue()
+        self.writer = threading.Thread(target=self.write_responses, daemon=True)
+        self.writer.start()
+
+    def respond(self, line, compress=None):
+        """Queue a response line; compress starts compression after it."""
+        self.responses.put((time.perf_counter() + self.server.latency, line, compress))
+
+    def write_responses(self):
+        codec = None
+        while True:
+            due, line, compress = self.responses.get()
+            if line is None:
+                return
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            data = line + b"\r\n"
+            try:
+                self.wfile.write(codec.compress(data) if codec else data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                return
+            if compress is not None:
+                codec = compress
+
+    def read(self, n):
+        data = self.rfile.read(n)
+        self.throttle(len(data))
+        return data
+
+    def readline(self):
+        line = self.rfile.readline()
+        self.throttle(len(line))
+        return line
+
+    def throttle(self, n):
+        """Sleep as needed to read no faster than the bandwidth of the server."""
+        if not self.server.bandwidth:
+            return
+        self.read_bytes += n
+        ahead = self.read_bytes / self.server.bandwidth - (time.perf_counter() - self.read_started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def handle(self):
+        self.respond(b"* OK fake IMAP server ready")
+        try:
+            while True:
+                line = self.readline()
+                if not line:
+                    return
+                tag, command, args = (line.rstrip(b"\r\n").split(b" ", 2) + [b"", b""])[:3]
+                command = command.decode("ascii", "replace").upper()
+                self.server.count(command)
+                method = getattr(self, "do_" + command, None)
+                if method is None:
+                    self.respond(tag + b" BAD unknown command")
+                elif method(tag, args) is False:
+                    return
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Let the last responses out before the connection is closed.
+            self.responses.put((0, None, None))
+            self.writer.join(self.server.latency + 5)
+
+    def do_CAPABILITY(self, tag, args):
+        self.respond(b"* CAPABILITY " + b" ".join(self.server.capabilities))
+        self.respond(tag + b" OK CAPABILITY completed")
+
+    def do_LOGIN(self, tag, args):
+        self.respond(tag + b" OK LOGIN completed")
+
+    def do_NOOP(self, tag, args):
+        self.respond(tag + b" OK NOOP completed")
+
+    def do_LOGOUT(self, tag, args):
+        self.respond(b"* BYE logging out")
+        self.respond(tag + b" OK LOGOUT completed")
+        return False
+
+    def do_COMPRESS(self, tag, args):
+        codec = imap_upload.DeflateCodec(imap_upload.CompressionStats())
+        self.respond(tag + b" OK DEFLATE active", compress=codec)
+        self.rfile = imap_upload.DeflateFile(self.rfile, codec)
+
+    def do_CREATE(self, tag, args):
+        if not self.server.create(unquote(args)):
+            self.respond(tag + b" NO [ALREADYEXISTS] mail box exists")
+        else:
+            self.respond(tag + b" OK CREATE completed")
+
+    def do_LIST(self, tag, args):
+        for name in self.server.box_names():
+            self.respond(b'* LIST (\\HasNoChildren) "/" "%s"' % name.encode("ascii", "replace"))
+        self.respond(tag + b" OK LIST completed")
+
+    def do_SELECT(self, tag, args):
+        name = unquote(args)
+        messages = self.server.messages(name)
+        if messages is None:
+            self.respond(tag + b" NO no such mail box")
+            return
+        self.selected = name
+        self.respond(b"* %d EXISTS" % len(messages))
+        self.respond(b"* OK [UIDVALIDITY 1] UIDs valid")
+        self.respond(b"* OK [UIDNEXT %d] predicted next UID" % (len(messages) + 1))
+        self.respond(tag + b" OK SELECT completed")
+
+    do_EXAMINE = do_SELECT
+
+    def do_APPEND(self, tag, args):
+        m = append_re.match(args)
+        name = unquote(m.group(1))
+        rest = m.group(2)
+        literals = []
+        while True:
+            m = literal_re.match(rest)
+            if not m.group(4):
+                self.respond(b"+ go ahead")
+            literals.append(self.read(int(m.group(3))))
+            rest = self.readline().rstrip(b"\r\n").lstrip(b" ")
+            if not rest:
+                break
+        limit = self.server.append_limit
+        if limit is not None and any(len(literal) > limit for literal in literals):
+            self.respond(tag + b" NO [TOOBIG] maximum message size exceeded")
+            return
+        if self.server.throttled(sum(len(literal) for literal in literals)):
+            self.respond(tag + b" NO [THROTTLED] too many messages, try again later")
+            return
+        outcome = self.server.append_outcome()
+        if outcome == "drop":
+            self.request.shutdown(socket.SHUT_RDWR)
+            return False
+        if outcome == "fail":
+            self.respond(tag + b" NO [UNAVAILABLE] injected failure")
+            return
+        uids = self.server.append(name, literals)
+        if uids is None:
+            self.respond(tag + b" NO [TRYCREATE] no such mail box")
+            return
+        self.respond(tag + b" OK [APPENDUID 1 %s] APPEND completed" % b",".join(b"%d" % uid for uid in uids))
+
+    def do_UID(self, tag, args):
+        command, args = (args.split(b" ", 1) + [b""])[:2]
+        messages = self.server.messages(self.selected) or []
+        if command.upper() == b"SEARCH":
+            self.respond(b"* SEARCH" + b"".join(b" %d" % (i + 1) for i in range(len(messages))))
+        elif command.upper() == b"FETCH":
+            uids, items = args.split(b" ", 1)
+            fields = fetch_fields_re.search(items).group(1).upper().split()
+            for uid in self.uid_set(uids, len(messages)):
+                header = messages[uid - 1].split(b"\r\n\r\n", 1)[0]
+                kept = b"".join(line + b"\r\n" for line in header.split(b"\r\n")
+                                if line.split(b":", 1)[0].upper() in fields) + b"\r\n"
+                self.respond(b"* %d FETCH (UID %d BODY[HEADER.FIELDS (%s)] {%d}\r\n" %
+                             (uid, uid, b" ".join(fields), len(kept)) + kept + b")")
+        elif command.upper() == b"COPY":
+            uids, name = args.split(b" ", 1)
+            if not self.server.append(unquote(name), [messages[uid - 1] for uid in
+                                                     self.uid_set(uids, len(messages))]):
+                self.respond(tag + b" NO [TRYCREATE] no such mail box")
+                return
+        else:
+            self.respond(tag + b" BAD unknown UID command")
+            return
+        self.respond(tag + b" OK UID completed")
+
+    @staticmethod
+    def uid_set(uids, count):
+        for first, last in uid_range_re.findall(uids):
+            last = count if last == b"*" else int(last or first)
+            yield from range(int(first), min(last, count) + 1)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """An IMAP server on 127.0.0.1, serving each connection from a thread.
+
+    latency is the delay in seconds of each response, bandwidth the number
+    of bytes per second read from each connection (None for no cap).
+    failure_rate and drop_rate are the shares of APPENDs answered with NO
+    and of those the connection is closed on instead of being answered.
+    Messages larger than append_limit bytes, which is then advertised as
+    APPENDLIMIT, are refused once read. Beyond throttle bytes appended in a
+    second, on all connections, APPENDs are answered with NO [THROTTLED].
+    Unless keep, messages are counted but not kept, for uploads larger
+    than the memory: they are empty when fetched.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, capabilities=("IMAP4rev1",), latency=0.0, bandwidth=None,
+                 failure_rate=0.0, drop_rate=0.0, seed=0, append_limit=None,
+                 throttle=None, keep=True):
+        super().__init__(("127.0.0.1", 0), Handler)
+        if append_limit is not None:
+            capabilities = tuple(capabilities) + ("APPENDLIMIT=%d" % append_limit,)
+        self.capabilities = [c.encode("ascii") for c in capabilities]
+        self.append_limit = append_limit
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.throttle = throttle
+        self.keep = keep
+        # (time, size) of the APPENDs of the last second, when throttling.
+        self.recent = collections.deque()
+        self.recent_bytes = 0
+        self.throttled_appends = 0
+        self.lock = threading.Lock()
+        self.boxes = {"INBOX": []}
+        self.commands = {}
+        self.appended = 0
+        self.appended_bytes = 0
+        self.first_append = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, command):
+        with self.lock:
+            self.commands[command] = self.commands.get(command, 0) + 1
+            if command == "APPEND" and self.first_append is None:
+                self.first_append = time.perf_counter()
+
+    def append_outcome(self):
+        with self.lock:
+            x = self.random.random()
+        if x < self.drop_rate:
+            return "drop"
+        if x < self.drop_rate + self.failure_rate:
+            return "fail"
+        return "ok"
+
+    def throttled(self, size):
+        """Tell whether an APPEND of size bytes goes beyond throttle, else count it."""
+        if self.throttle is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and self.recent[0][0] <= now - 1.0:
+                self.recent_bytes -= self.recent.popleft()[1]
+            if self.recent_bytes + size > self.throttle:
+                self.throttled_appends += 1
+                return True
+            self.recent.append((now, size))
+            self.recent_bytes += size
+            return False
+
+    def create(self, name):
+        with self.lock:
+            if name in self.boxes:
+                return False
+            self.boxes[name] = []
+            return True
+
+    def box_names(self):
+        with self.lock:
+            return list(self.boxes)
+
+    def messages(self, name):
+        with self.lock:
+            return self.boxes.get(name)
+
+    def append(self, name, messages):
+        """Store messages in a box; return their UIDs, None if there is no such box."""
+        with self.lock:
+            box = self.boxes.get(name)
+            if box is None:
+                return None
+            self.appended += len(messages)
+            self.appended_bytes += sum(len(m) for m in messages)
+            box.extend(messages if self.keep else [b""] * len(messages))
+            return range(len(box) - len(messages) + 1, len(box) + 1)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Check that importing imap_upload stays fast.
+
+Starts a new interpreter a few times to import the module, and compares the
+best time, less that of an interpreter importing nothing, with a budget.
+Exits with status 1 when over budget.
+
+    python benchmarks/import_time.py [--runs N] [--budget SECONDS]
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_time(code, runs):
+    """Return the shortest time a new interpreter takes to run code."""
+    best = float("inf")
+    for i in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--runs", type="int", default=5,
+                      help="start the interpreter RUNS times [default: %default]")
+    parser.add_option("--budget", type="float", default=0.5,
+                      help="fail above BUDGET seconds [default: %default]")
+    options, args = parser.parse_args(args)
+
+    # Compile the module first: the runs should not include that.
+    best_time("import imap_upload", 1)
+    baseline = best_time("pass", options.runs)
+    elapsed = best_time("import imap_upload", options.runs) - baseline
+    print("import imap_upload: %.3f s (budget %.3f s)" % (elapsed, options.budget))
+    return 0 if elapsed <= options.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
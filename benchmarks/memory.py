@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Check that the memory imap_upload uses stays bounded on a huge mbox.
+
+Uploads a generated mbox of a few gigabytes, small messages with some of
+hundreds of megabytes among them, to a FakeIMAPServer that counts the
+messages without keeping them. Reports the peak RSS of the uploading
+process, and exits with status 1 if it is above --max-rss or if messages
+were not all stored. With --append-limit, the server refuses the messages
+above it, which go to the --error mbox instead. Other arguments are passed
+on to imap_upload.py.
+
+    python benchmarks/memory.py [--gigabytes N] [--max-rss MB] [--mbox FILE] [--append-limit MB] [-- OPTIONS]
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+import corpora
+import imap_upload
+from fakeimap import FakeIMAPServer
+from run import ALL, PEAK_RSS
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options] [-- imap_upload options]")
+    parser.add_option("--gigabytes", type="float", default=3.0,
+                      help="size of the mbox generated [default: %default]")
+    parser.add_option("--max-rss", type="float", default=256.0, metavar="MB",
+                      help="fail if the peak RSS is above MB megabytes [default: %default]")
+    parser.add_option("--mbox", metavar="FILE",
+                      help="generate the mbox as FILE and keep it, or use FILE if it exists already")
+    parser.add_option("--append-limit", type="float", metavar="MB",
+                      help="have the server refuse messages above MB megabytes")
+    options, args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        mbox = options.mbox or os.path.join(directory, "giant.mbox")
+        if not os.path.exists(mbox):
+            print("Generating %.1f GB of messages..." % options.gigabytes, flush=True)
+            corpora.giant(mbox, options.gigabytes)
+        src = imap_upload.MboxReader(mbox)
+        count = src.count()
+        largest = max(len(msg.data) for msg in src)
+        src.close()
+        print("%d messages, %.1f MB, the largest %.1f MB" % (count, os.path.getsize(mbox) / 1e6, largest / 1e6),
+              flush=True)
+
+        append_limit = None if options.append_limit is None else int(options.append_limit * 1e6)
+        server = FakeIMAPServer(ALL, keep=False, append_limit=append_limit).start()
+        command = [sys.executable, "-c", PEAK_RSS, os.path.join(os.path.dirname(BENCHMARKS), "imap_upload.py"),
+                   "--host", "127.0.0.1", "--port", str(server.port), "--user", "bench", "--password", "bench",
+                   "--quiet", "--error", os.path.join(directory, "errors.mbox")] + args + [mbox]
+        started = time.perf_counter()
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        elapsed = time.perf_counter() - started
+        server.stop()
+
+    lines = output.decode("utf-8", "replace").splitlines()
+    peak_rss = [int(line.split()[2]) * 1024 / 1e6 for line in lines if line.startswith("Peak RSS:")]
+    done = [line for line in lines if line.startswith("Done")]
+    print(done[-1] if done else "\n".join(lines[-10:]))
+    print("%.1f sec, %.1f MB/s, peak RSS %s MB (at most %.1f MB)" %
+          (elapsed, server.appended_bytes / elapsed / 1e6, "%.1f" % peak_rss[-1] if peak_rss else "?",
+           options.max_rss))
+    ok = True
+    if not peak_rss or peak_rss[-1] > options.max_rss:
+        print("FAILED: the peak RSS is above the limit")
+        ok = False
+    # The messages refused as too large are counted as errors.
+    errors = int(done[-1].split("ERROR: ")[1].split(",")[0]) if done else 0
+    if server.appended + errors != count or (errors and append_limit is None):
+        print("FAILED: %d messages stored out of %d" % (server.appended, count))
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
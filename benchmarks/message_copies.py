@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Check that a message is serialized only once, however many boxes it goes to.
+
+Uploads a large Google Takeout message with several labels through an
+in-process connection that only records what it is given. Checks that each
+APPEND gets the same literal, that 8-bit content comes through unchanged, and
+that memory allocated while uploading stays within two copies of the message:
+its bytes in the mbox, and its literal with CRLF line endings. Then the same
+message, above --stream-size, is uploaded from the mbox a piece at a time:
+the memory allocated must stay within a few of these pieces, whatever its
+size.
+
+    python benchmarks/message_copies.py [--size MIB]
+"""
+
+import hashlib
+import optparse
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import imap_upload
+
+LABELS = ["Work", "Family", "Travel"]
+
+
+class RecordingConnection:
+    """Stands for imaplib.IMAP4 and keeps the literal of each APPEND, and its digest.
+
+    A streamed literal can only be read while its mbox is open, hence the
+    digests, taken a piece at a time as it would be sent.
+    """
+
+    capabilities = ("IMAP4REV1",)
+
+    def __init__(self):
+        self.literals = []
+        self.digests = []
+
+    def login(self, user, password):
+        return "OK", [b"done"]
+
+    def create(self, mailbox):
+        return "OK", [b"done"]
+
+    def list(self):
+        return "OK", []
+
+    def append(self, mailbox, flags, date_time, message):
+        flags, date_time, literal = imap_upload.append_arguments(flags, date_time, message)
+        self.literals.append(literal)
+        digest = hashlib.sha256()
+        for piece in imap_upload.data_pieces(literal):
+            digest.update(piece)
+        self.digests.append(digest.digest())
+        return "OK", [b"done"]
+
+    def shutdown(self):
+        pass
+
+
+class RecordingUploader(imap_upload.IMAPUploader):
+
+    def connect(self):
+        return RecordingConnection()
+
+
+def write_mbox(path, size):
+    """Write a message of about size bytes, with 8-bit lines, to path."""
+    line = "Caf\xe9 cr\xe8me br\xfbl\xe9e ☃ ".encode("utf-8") * 4 + b"\n"
+    with open(path, "wb") as f:
+        f.write(b"From someone@example.com Sat Jan  3 01:05:34 2009\n")
+        f.write(b"X-Gmail-Labels: " + ",".join(LABELS).encode("ascii") + b"\n")
+        f.write(b"Subject: large\nDate: Sat, 3 Jan 2009 01:05:34 +0000\n\n")
+        f.write(line * (size // len(line)))
+
+
+def upload(path, stream_size):
+    """Upload the mbox at path; return the connection used and the peak memory allocated."""
+    uploader = RecordingUploader("localhost", 143, False, "INBOX", "", "", 0, "/", False)
+    src = imap_upload.MboxReader(path, stream_size)
+    try:
+        tracemalloc.start()
+        imap_upload.upload(uploader, "INBOX", src, None, [], google_takeout=True)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        src.close()
+    return uploader.imap, peak
+
+
+def check(imap, expected, peak, max_peak):
+    """Print what was sent and tell whether it is as expected."""
+    literals = imap.literals
+    copies = peak / len(expected)
+    print("%d APPENDs, %d distinct literals, peak %.2f copies of the message" %
+          (len(literals), len(set(map(id, literals))), copies))
+    ok = len(literals) == len(LABELS)
+    ok = ok and all(literal is literals[0] for literal in literals)
+    ok = ok and all(digest == hashlib.sha256(expected).digest() for digest in imap.digests)
+    ok = ok and len(literals[0]) == len(expected)
+    return ok and peak < max_peak
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--size", type="int", default=16,
+                      help="size of the message in MiB [default: %default]")
+    options, args = parser.parse_args(args)
+    size = options.size * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "large.mbox")
+        write_mbox(path, size)
+        with open(path, "rb") as f:
+            expected = imap_upload.imaplib.MapCRLF.sub(b"\r\n", f.read().split(b"\n", 1)[1])
+        imap, peak = upload(path, 2 * size)
+        ok = check(imap, expected, peak, 2.5 * len(expected))
+        imap, peak = upload(path, size // 4)
+        ok = check(imap, expected, peak, 4 * imap_upload.MappedRegion.piece_size) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Measure the upload throughput of imap_upload against a local fake server.
+
+Each scenario uploads a generated corpus with imap_upload.py, run as a
+separate process, to a FakeIMAPServer of its own. For each one this reports
+messages and megabytes per second, the peak RSS of the uploading process
+and the time from its start to the first APPEND the server receives. No
+network access is needed.
+
+    python benchmarks/run.py [--scale X] [--scenario NAME]... [--json FILE]
+"""
+
+import json
+import optparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+import corpora
+import imap_upload
+from fakeimap import FakeIMAPServer
+
+ALL = ("IMAP4rev1", "LITERAL+", "MULTIAPPEND", "UIDPLUS", "COMPRESS=DEFLATE")
+
+# name: (corpus, imap_upload.py arguments, FakeIMAPServer arguments). The
+# preload argument is the share of the messages stored before the upload.
+SCENARIOS = {
+    "tiny": ("tiny", [], {}),
+    "tiny-latency": ("tiny", [], {"latency": 0.005}),
+    "tiny-pipeline": ("tiny", ["--pipeline", "8"], {"latency": 0.005, "capabilities": ALL}),
+    "tiny-connections": ("tiny", ["--connections", "4"], {"latency": 0.005}),
+    "tiny-batch": ("tiny", ["--batch-size", "50"], {"latency": 0.005, "capabilities": ALL}),
+    # Messages failing before being sent, among those being batched.
+    "faulty-batch": ("faulty", ["--batch-size", "10"], {"capabilities": ALL}),
+    "faulty-parse-workers": ("faulty", ["--parse-workers", "2"], {"capabilities": ALL}),
+    # Half the messages are on the server already, often two or more in a row.
+    "tiny-skip-existing": ("tiny", ["--skip-existing", "--batch-size", "10"],
+                           {"capabilities": ALL, "preload": 0.5}),
+    # Some messages are above the APPENDLIMIT, at times two or more in a row.
+    "tiny-limit-batch": ("tiny", ["--batch-size", "10"], {"capabilities": ALL, "append_limit": 2048}),
+    "tiny-failures": ("tiny", ["--retry", "3"], {"failure_rate": 0.01, "drop_rate": 0.001}),
+    "tiny-throttled": ("tiny", ["--connections", "4", "--retry", "3"],
+                       {"latency": 0.002, "throttle": 512 * 1024}),
+    "tiny-adaptive": ("tiny", ["--connections", "4", "--retry", "3", "--adaptive"],
+                      {"latency": 0.002, "throttle": 512 * 1024}),
+    "tiny-gzip": ("tiny-gz", [], {}),
+    "tiny-xz": ("tiny-xz", [], {}),
+    "huge": ("huge", [], {}),
+    "huge-bandwidth": ("huge", [], {"bandwidth": 20 * 1024 * 1024}),
+    "huge-gzip": ("huge-gz", [], {}),
+    "huge-compress": ("huge", ["--compress"], {"bandwidth": 20 * 1024 * 1024, "capabilities": ALL}),
+    "mixed-limit": ("mixed", [], {"latency": 0.002, "append_limit": 8 * 1024 * 1024}),
+    "mixed-connections": ("mixed", ["--connections", "4"],
+                          {"latency": 0.005, "bandwidth": 20 * 1024 * 1024, "append_limit": 8 * 1024 * 1024}),
+    # The small messages go on while the large one is sent on its own connection.
+    "large-first-connections": ("large-first", ["--connections", "4"],
+                                {"latency": 0.01, "bandwidth": 6 * 1024 * 1024}),
+    "takeout": ("takeout", ["--google-takeout"], {"latency": 0.002}),
+    "takeout-uidplus": ("takeout", ["--google-takeout"], {"latency": 0.002, "capabilities": ALL}),
+    "takeout-gzip": ("takeout-gz", ["--google-takeout"], {"latency": 0.002}),
+    "takeout-pipeline": ("takeout", ["--google-takeout", "--pipeline", "8"], {"capabilities": ALL}),
+    "takeout-parse-workers": ("takeout", ["--google-takeout", "--pipeline", "8", "--parse-workers", "2"],
+                              {"capabilities": ALL}),
+    "tree": ("tree", ["-r"], {"latency": 0.002}),
+    "tree-mailboxes": ("tree", ["-r", "--mailboxes", "4", "--connections", "4"], {"latency": 0.002}),
+}
+
+
+# Runs the script given as first argument, then prints its peak RSS where
+# /proc tells it. The one getrusage() gives for a child process on Linux may
+# be that of the process it was forked from.
+PEAK_RSS = """
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    try:
+        with open("/proc/self/status") as f:
+            peak = [line.split()[1] for line in f if line.startswith("VmHWM:")]
+        print("Peak RSS: %d kB" % int(peak[0]))
+    except (OSError, IndexError):
+        pass
+"""
+
+
+def preload(server, mbox, share, seed=0):
+    """Store about share of the messages of mbox in the INBOX of server, picked at random."""
+    rng = random.Random(seed)
+    src = imap_upload.MboxReader(mbox)
+    try:
+        server.append("INBOX", [imap_upload.crlf_lines(msg.data) for msg in src if rng.random() < share])
+    finally:
+        src.close()
+
+
+def run(name, mbox, arguments, server_arguments, errors):
+    """Run one scenario and return its measures."""
+    server_arguments = dict(server_arguments)
+    share = server_arguments.pop("preload", 0)
+    server = FakeIMAPServer(**server_arguments).start()
+    if share:
+        preload(server, mbox, share)
+    command = [sys.executable, "-c", PEAK_RSS, os.path.join(os.path.dirname(BENCHMARKS), "imap_upload.py"),
+               "--host", "127.0.0.1", "--port", str(server.port), "--user", "bench", "--password", "bench",
+               "--error", errors] + arguments + [mbox]
+    with tempfile.TemporaryFile() as output:
+        started = time.perf_counter()
+        returncode = subprocess.call(command, stdout=output, stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - started
+        output.seek(0)
+        lines = output.read().decode("utf-8", "replace").splitlines()
+    server.stop()
+    size = count = 0
+    for directory, folders, files in os.walk(mbox) if os.path.isdir(mbox) else [("", [], [mbox])]:
+        for name in files:
+            src = imap_upload.open_mbox(os.path.join(directory, name))
+            if src.random_access:
+                size += src.size
+                count += src.count()
+            else:
+                # The rates of a compressed mbox are of the messages in it.
+                for msg in src:
+                    count += 1
+                    end = msg.offset + len(msg.from_line) + 1 + len(msg.data)
+                size += end
+            src.close()
+    done = [line for line in lines if line.startswith("Done")]
+    peak_rss = [int(line.split()[2]) * 1024 for line in lines if line.startswith("Peak RSS:")]
+    return {
+        "scenario": name,
+        "returncode": returncode,
+        "seconds": elapsed,
+        "messages": count,
+        "stored": server.appended,
+        "msgs_per_sec": count / elapsed,
+        "mb_per_sec": size / elapsed / 1e6,
+        "peak_rss_mb": peak_rss[-1] / 1e6 if peak_rss else None,
+        "first_append_sec": None if server.first_append is None else server.first_append - started,
+        "commands": server.commands,
+        "summary": done[-1] if done else (lines[-1] if lines else ""),
+    }
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--scale", type="float", default=0.2,
+                      help="multiply the number of messages of each corpus by X [default: %default]")
+    parser.add_option("--scenario", action="append", dest="scenarios", metavar="NAME",
+                      help="run scenario NAME only; may be repeated. One of: " + ", ".join(SCENARIOS))
+    parser.add_option("--json", metavar="FILE",
+                      help="also write the measures to FILE, one JSON object per line")
+    options, args = parser.parse_args(args)
+    names = options.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %r" % name)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        # The mbox file, or tree of them, of each corpus.
+        mboxes = {}
+        print("%-22s %8s %8s %9s %8s %9s %11s  %s" %
+              ("scenario", "msgs", "seconds", "msgs/s", "MB/s", "RSS MB", "1st APPEND", "summary"))
+        for name in names:
+            corpus, arguments, server_arguments = SCENARIOS[name]
+            if corpus not in mboxes:
+                mboxes[corpus] = corpora.CORPORA[corpus](os.path.join(directory, corpus + ".mbox"), options.scale)
+            result = run(name, mboxes[corpus], arguments, server_arguments,
+                         os.path.join(directory, name + ".errors.mbox"))
+            results.append(result)
+            first = result["first_append_sec"]
+            rss = result["peak_rss_mb"]
+            print("%-22s %8d %8.2f %9.1f %8.2f %9s %11s  %s" %
+                  (name, result["messages"], result["seconds"], result["msgs_per_sec"], result["mb_per_sec"],
+                   "-" if rss is None else "%.1f" % rss, "-" if first is None else "%.3f s" % first,
+                   result["summary"]))
+    if options.json:
+        with open(options.json, "a") as f:
+            for result in results:
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+    return 0 if all(result["returncode"] == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,43 @@
 #!/usr/bin/python3
 # coding=utf-8
+import asyncio
+import bisect
+import bz2
 import codecs
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import email
 import email.header
+import functools
 import getpass
+import gzip
+import hashlib
 import imaplib
+import itertools
+import json
 import locale
+import lzma
 import mailbox
 import math
+import mmap
+import multiprocessing
 import optparse
+import random
 import re
 import socket
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
 import time
 import unicodedata
 import urllib.request, urllib.parse, urllib.error
+import zlib
 import os
+import pickle
 import traceback
 import io
 import csv
@@ -25,36 +47,18 @@ from imapclient import imap_utf7
 
 __version__ = "2.0.0"
 
-if sys.version_info < (3, 5):
-    print("IMAP Upload requires Python 3.5 or later.")
+if sys.version_info < (3, 7):
+    print("IMAP Upload requires Python 3.7 or later.")
     sys.exit(1)
 
-# Avoid "KeyError: 'content-transfer-encoding'" error.
-# Inspired from https://github.com/python/cpython/issues/71508#issuecomment-1093718177
-# This workaround might no longer needed when python 3.10 is a minimum version
-# That way you could just use msg.as_string()
-class ImapUploadMessage(email.message.Message):
-
-    @staticmethod
-    def as_string(self):
-        # Work around for https://bugs.python.org/issue27321 and
-        # https://bugs.python.org/issue32330.
-        try:
-            value = email.message.Message.as_string(self)
-        except (KeyError, LookupError, UnicodeEncodeError):
-            value = email.message.Message.as_bytes(self).decode(
-                'ascii', 'replace')
-        # Also ensure no unicode surrogates in the returned string.
-        return email.utils._sanitize(value)
-
 class MyOptionParser(OptionParser):
     def __init__(self):
         usage = "usage: python %prog [options] (MBOX|-r MBOX_FOLDER) [DEST]\n"\
-                "  MBOX UNIX style mbox file.\n"\
+                "  MBOX UNIX style mbox file, maybe compressed (.gz, .bz2, .xz, .zst).\n"\
                 "  MBOX_FOLDER folder containing subfolder trees of mbox files\n"\
                 "  DEST is imap[s]://[USER[:PASSWORD]@]HOST[:PORT][/BOX]\n"\
                 "  DEST has a priority over the options."
-        self.google_takeout_supported_languages = [ "en", "es", "ca", "de" ]
+        self.google_takeout_supported_languages = TakeoutLabels.languages()
         OptionParser.__init__(self, usage,
                               version="IMAP Upload " + __version__)
         self.add_option("-r", action="store_true",
@@ -90,8 +94,31 @@ class MyOptionParser(OptionParser):
         self.add_option("--retry", type="int", metavar="COUNT",
                         help="retry COUNT times on connection abort. "
                              "0 disables [default: %default]")
+        self.add_option("--reconnect-budget", type="float", metavar="SECONDS",
+                        help="give up reconnecting once SECONDS were spent "
+                             "waiting to, in all [default: no limit]")
+        self.add_option("--adaptive", action="store_true",
+                        help="send fewer messages at once and slower when "
+                             "the server throttles or slows down, and more "
+                             "again as it keeps up")
+        self.add_option("--daily-bytes", type="int", metavar="BYTES",
+                        help="upload at most BYTES of messages a day, then "
+                             "wait for the next one [default: no limit]")
+        self.add_option("--stream-size", type="int", metavar="BYTES",
+                        help="read the messages larger than BYTES from the "
+                             "mbox file a piece at a time as they are sent, "
+                             "never whole in memory [default: %default]")
         self.add_option("--error", metavar="ERR_MBOX",
                         help="append failured messages to the file ERR_MBOX")
+        self.add_option("--replay-errors", action="store_true",
+                        help="upload the messages of MBOX, the ERR_MBOX of an "
+                             "earlier run, to the boxes they failed to go to")
+        self.add_option("--resume", action="store_true",
+                        help="record the uploaded messages in MBOX.journal "
+                             "and skip the ones it lists when run again")
+        self.add_option("--skip-existing", action="store_true",
+                        help="do not upload the messages found in the destination "
+                             "mail box already, by Message-ID")
         self.add_option("--time-fields", metavar="LIST", type="string", nargs=1,
                         action="callback", callback=self.set_time_fields,
                         help="try to get delivery time of message from "
@@ -119,6 +146,42 @@ class MyOptionParser(OptionParser):
                         help="[Use specific language. Supported languages: '%s'. " % (" ".join(self.google_takeout_supported_languages)) + "default: %default]" )
         self.add_option("--maximum-size-exceeded-are-warnings", action="store_true",
                         help="Treat 'maximum size exceeded messages' as warnings and not as errors.")
+        self.add_option("--connections", type="int", metavar="N",
+                        help="upload over N connections at once [default: %default]")
+        self.add_option("--compress", action="store_true",
+                        help="compress the connection if the server supports "
+                             "COMPRESS=DEFLATE")
+        self.add_option("--batch-size", type="int", metavar="COUNT",
+                        help="append up to COUNT consecutive messages for the same "
+                             "mail box with one command, if the server supports "
+                             "MULTIAPPEND [default: %default]")
+        self.add_option("--batch-bytes", type="int", metavar="BYTES",
+                        help="limit the size of such a batch to BYTES "
+                             "[default: %default]")
+        self.add_option("--pipeline", type="int", metavar="DEPTH",
+                        help="keep up to DEPTH APPEND commands in flight on "
+                             "each connection [default: %default]")
+        self.add_option("--mailboxes", type="int", metavar="N",
+                        help="with -r, upload N mbox files at once, the "
+                             "largest first [default: %default]")
+        self.add_option("--parse-workers", type="int", metavar="N",
+                        help="parse the messages in N processes while they "
+                             "are uploaded. 0 parses them in the uploading "
+                             "process [default: %default]")
+        self.add_option("--keep-order", action="store_true",
+                        help="with --connections, append the messages of a "
+                             "mail box in the order of the mbox")
+        self.add_option("--metrics", metavar="FILE",
+                        help="write counters and per-phase timings to FILE "
+                             "while uploading")
+        self.add_option("--metrics-format", type="choice", choices=["json", "prometheus"],
+                        help="append a line of JSON to FILE each time, or replace "
+                             "it with the Prometheus text format: json or "
+                             "prometheus [default: %default]")
+        self.add_option("--metrics-interval", type="float", metavar="SECONDS",
+                        help="write the metrics every SECONDS [default: %default]")
+        self.add_option("--quiet", action="store_true",
+                        help="only print the messages that could not be uploaded")
         self.add_option("--debug", action="store_true",
                         help="Debug: Make some error messages more verbose.")
         self.add_option("--dry-run", action="store_true",
@@ -131,7 +194,14 @@ class MyOptionParser(OptionParser):
                           password="",
                           box="INBOX",
                           retry=0,
+                          reconnect_budget=None,
                           error=None,
+                          resume=False,
+                          skip_existing=False,
+                          replay_errors=False,
+                          adaptive=False,
+                          daily_bytes=None,
+                          stream_size=MboxReader.stream_size,
                           time_fields=["from", "received", "date"],
                           folder_separator="/",
                           google_takeout=False,
@@ -140,6 +210,18 @@ class MyOptionParser(OptionParser):
                           google_takeout_label_priority="",
                           google_takeout_language="en",
                           maximum_size_exceeded_are_warnings=False,
+                          compress=False,
+                          connections=1,
+                          pipeline=1,
+                          batch_size=1,
+                          batch_bytes=1024 * 1024,
+                          mailboxes=1,
+                          parse_workers=0,
+                          keep_order=False,
+                          metrics=None,
+                          metrics_format="json",
+                          metrics_interval=10.0,
+                          quiet=False,
                           debug=False,
                           dry_run=False,
                           )
@@ -189,6 +271,15 @@ class MyOptionParser(OptionParser):
             self.error("--google-takeout-label-priority needs --google-takeout-first-label option")
         if (not (options.google_takeout_language in self.google_takeout_supported_languages)):
             self.error("--google-takeout-language: '%s' is not a supported language. Supported languages: '%s'." % (options.google_takeout_language, " ".join(self.google_takeout_supported_languages)))
+        if options.connections < 1:
+            self.error("--connections must be at least 1")
+        if options.pipeline < 1:
+            self.error("--pipeline must be at least 1")
+        if options.replay_errors and (options.r or options.google_takeout):
+            self.error("--replay-errors cannot be used with -r or --google-takeout")
+        if options.replay_errors and options.error and \
+                os.path.realpath(options.error) == os.path.realpath(args[0]):
+            self.error("--replay-errors: give another ERR_MBOX for the messages that fail again")
         if options.port is None:
             options.port = [143, 993][options.ssl]
         if not options.list_boxes:
@@ -227,6 +318,12 @@ def si_prefix(n, prefixes=("", "k", "M", "G", "T", "P", "E", "Z", "Y"),
         return (n, prefixes[0])
     return si_prefix(n / block, prefixes[1:])
 
+def format_duration(seconds):
+    """Format a number of seconds as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
 def decode_header_to_string(header):
     """Decodes an email message header (possibly RFC2047-encoded)
     into a string, while working around https://bugs.python.org/issue22833"""
@@ -242,225 +339,806 @@ def decode_header_to_string(header):
         _decode(bytestr, encoding)
         for bytestr, encoding in email.header.decode_header(header))
 
-all_chars = (chr(i) for i in range(sys.maxunicode))
-categories = {'Cc', 'Cf', 'Cs', 'Co', 'Cn'}
-control_chars = ''.join(c for c in all_chars if unicodedata.category(c) in categories)
-# or equivalently and much more efficiently
-#control_chars = ''.join(map(chr, itertools.chain(range(0x00,0x20), range(0x7f,0xa0))))
-
-control_char_re = re.compile('[%s]' % re.escape(control_chars))
+# Unicode categories of the characters not to print: control, format,
+# surrogate, private use and unassigned.
+control_categories = frozenset(('Cc', 'Cf', 'Cs', 'Co', 'Cn'))
 
 def remove_control_chars(s):
-    return control_char_re.sub('', s)
+    # None of these are printable: most strings are returned at once,
+    # without looking up the category of each character.
+    if s.isprintable():
+        return s
+    return ''.join(c for c in s if unicodedata.category(c) not in control_categories)
+
+
+class Metrics:
+    """Count what an upload does and time each of its phases.
+
+    The phases are timed into histograms: parse (headers and labels), date
+    (delivery time), serialize (the IMAP literal), folders (CREATE), append,
+    copy and fetch (server round trips), wait (for the oldest message in
+    flight), error_mbox, reconnect (the sleep before it), retry (the sleep
+    before trying failed messages again), throttle and budget (the waits
+    of RateController). Messages and bytes are counted in total and per
+    destination box. It may be updated from several threads at once.
+    """
 
-all_chars = (chr(i) for i in range(sys.maxunicode))
-categories = {'Cc', 'Cf', 'Cs', 'Co', 'Cn'}
-control_chars = ''.join(c for c in all_chars if unicodedata.category(c) in categories)
-# or equivalently and much more efficiently
-#control_chars = ''.join(map(chr, itertools.chain(range(0x00,0x20), range(0x7f,0xa0))))
+    # Upper bounds of the buckets of the histograms, in seconds.
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    statuses = ("ok", "warning", "error", "skipped")
 
-control_char_re = re.compile('[%s]' % re.escape(control_chars))
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time_started = time.time()
+        self.counters = dict.fromkeys(("bytes_read", "bytes_sent", "reconnects", "deferred", "throttled"), 0)
+        self.messages = dict.fromkeys(self.statuses, 0)
+        # phase: [count, sum, max, count per bucket]
+        self.timers = {}
+        # box: {status: count, "bytes": count}
+        self.boxes = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            timer = self.timers.get(phase)
+            if timer is None:
+                timer = self.timers[phase] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            i = bisect.bisect_left(self.buckets, seconds)
+            if i < len(self.buckets):
+                timer[3][i] += 1
+
+    def seconds(self, phase):
+        """Return the time spent in phase so far."""
+        with self.lock:
+            timer = self.timers.get(phase)
+            return 0.0 if timer is None else timer[1]
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Time the body of a with statement as phase."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - started)
+
+    def count_message(self, box, status, size):
+        """Count a message of size bytes for box, None if not known yet."""
+        with self.lock:
+            self.messages[status] += 1
+            self.counters["bytes_read"] += size
+            if box is not None:
+                totals = self.boxes.get(box)
+                if totals is None:
+                    totals = self.boxes[box] = dict.fromkeys(self.statuses + ("bytes",), 0)
+                totals[status] += 1
+                totals["bytes"] += size
+
+    def as_json(self):
+        """Return the metrics as one line of JSON."""
+        with self.lock:
+            timers = {}
+            for phase, (count, total, longest, buckets) in self.timers.items():
+                cumulative = itertools.accumulate(buckets)
+                timers[phase] = {"count": count, "sum": round(total, 6), "max": round(longest, 6),
+                                 "buckets": dict(zip(map(str, self.buckets), cumulative))}
+            return json.dumps({"time": time.time(), "elapsed": round(time.time() - self.time_started, 3),
+                               "messages": self.messages, "counters": self.counters,
+                               "timers": timers, "boxes": self.boxes}, sort_keys=True)
+
+    def as_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        def label(value):
+            return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        with self.lock:
+            lines = ["# TYPE imap_upload_elapsed_seconds gauge",
+                     "imap_upload_elapsed_seconds %.3f" % (time.time() - self.time_started),
+                     "# TYPE imap_upload_messages_total counter"]
+            lines.extend("imap_upload_messages_total{status=%s} %d" % (label(status), count)
+                         for status, count in self.messages.items())
+            for name, count in sorted(self.counters.items()):
+                lines.append("# TYPE imap_upload_%s_total counter" % name)
+                lines.append("imap_upload_%s_total %d" % (name, count))
+            lines.append("# TYPE imap_upload_phase_seconds histogram")
+            for phase, (count, total, longest, buckets) in sorted(self.timers.items()):
+                for bound, cumulative in zip(self.buckets, itertools.accumulate(buckets)):
+                    lines.append('imap_upload_phase_seconds_bucket{phase=%s,le="%s"} %d' %
+                                 (label(phase), bound, cumulative))
+                lines.append('imap_upload_phase_seconds_bucket{phase=%s,le="+Inf"} %d' % (label(phase), count))
+                lines.append("imap_upload_phase_seconds_sum{phase=%s} %.6f" % (label(phase), total))
+                lines.append("imap_upload_phase_seconds_count{phase=%s} %d" % (label(phase), count))
+            lines.append("# TYPE imap_upload_box_messages_total counter")
+            for box, totals in sorted(self.boxes.items()):
+                lines.extend("imap_upload_box_messages_total{box=%s,status=%s} %d" %
+                             (label(box), label(status), totals[status]) for status in self.statuses)
+            lines.append("# TYPE imap_upload_box_bytes_total counter")
+            lines.extend("imap_upload_box_bytes_total{box=%s} %d" % (label(box), totals["bytes"])
+                         for box, totals in sorted(self.boxes.items()))
+            return "\n".join(lines) + "\n"
+
+
+class MetricsWriter:
+    """Write metrics to a file every interval seconds, from a thread.
+
+    In the "json" format a line is appended to the file each time; in the
+    "prometheus" format the file is replaced, for the textfile collector of
+    the node exporter to pick up.
+    """
 
-def remove_control_chars(s):
-    return control_char_re.sub('', s)
+    def __init__(self, metrics, path, format="json", interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.format == "prometheus":
+            with open(self.path + ".tmp", "w") as f:
+                f.write(self.metrics.as_prometheus())
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            with open(self.path, "a") as f:
+                f.write(self.metrics.as_json() + "\n")
+
+    def close(self):
+        """Stop the thread and write the metrics a last time."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.write()
+
+
+class TakeoutLabels:
+    """Map the X-Gmail-Labels header of Google Takeout messages to flags and boxes.
+
+    The names of the labels Gmail gives a meaning to depend on the language
+    of the account. Those of the languages in builtin are here, so that the
+    script works alone; those of other languages are read from LANGUAGE.json
+    in the directory google_takeout_languages next to this script, and
+    adding a language is adding such a file. The inbox and sent names are
+    regular expressions replaced in the whole header, category and imap
+    ones regular expressions matching the beginning of the labels to leave
+    out, the others label names.
+
+    The same header comes with many messages: the result for each distinct
+    one is computed once and cached.
+    """
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "google_takeout_languages")
+    builtin = {
+        "en": {"inbox": "Inbox", "sent": "Sent", "draft": "Draft", "important": "Important",
+               "opened": "Open", "unread": "Unread", "category": "^Category_", "imap": "^IMAP_",
+               "trash": "Trash"},
+        "es": {"inbox": "Recibidos", "sent": "Enviados", "draft": "Borradores", "important": "Importante",
+               "opened": "Abierto", "unread": "No leídos", "category": "^Categor.a:", "imap": "^IMAP_",
+               "trash": "Papelera"},
+        "ca": {"inbox": "Safata d'entrada", "sent": "Enviats", "draft": "Esborranys", "important": "Importants",
+               "opened": "Oberts", "unread": "No llegits", "category": "^Categor.a", "imap": "^IMAP_",
+               "trash": "Paperera"},
+        "de": {"inbox": "Posteingang", "sent": "Gesendet", "draft": "Entwürfe", "important": "Wichtig",
+               "opened": "Geöffnet", "unread": "Ungelesen", "category": "^Kategorie_", "imap": "^IMAP_",
+               "trash": "Papierkorb"},
+    }
+    cache_size = 4096
+
+    def __init__(self, language="en", first_label=False, label_priority=None):
+        names = self.names(language)
+        self.inbox_re = re.compile(names["inbox"])
+        self.sent_re = re.compile(names["sent"])
+        self.category_re = re.compile(names["category"])
+        self.imap_re = re.compile(names["imap"])
+        self.sent = names["sent"]
+        self.draft = names["draft"]
+        self.important = names["important"]
+        self.opened = names["opened"]
+        self.unread = names["unread"]
+        self.trash = names["trash"]
+        self.first_label = first_label
+        self.label_priority = label_priority or []
+        self.cached = functools.lru_cache(self.cache_size)(self.parse)
+
+    @classmethod
+    def names(cls, language):
+        """Return the label names of language, built in or from its file."""
+        if language in cls.builtin:
+            return cls.builtin[language]
+        with open(os.path.join(cls.directory, language + ".json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    @classmethod
+    def languages(cls):
+        """Return the languages built in or there is a file for."""
+        languages = set(cls.builtin)
+        if os.path.isdir(cls.directory):
+            languages.update(name[:-len(".json")] for name in os.listdir(cls.directory) if name.endswith(".json"))
+        return sorted(languages)
+
+    def lookup(self, header):
+        """Return the flags and boxes of a message from its raw X-Gmail-Labels header."""
+        flags, boxes = self.cached(header)
+        # The caller may change them; the cached ones must not be.
+        return (flags if isinstance(flags, str) else []), [list(box) for box in boxes]
+
+    def parse(self, header):
+        label = decode_header_to_string(header)
+        label = label.replace("\n\r", "").replace("\r\n", "").replace("\r", " ").replace("\n", "")
+        label = self.inbox_re.sub("INBOX", label)
+        label = self.sent_re.sub("Sent", label)
+
+        labels = [csv_label for csv_line in csv.reader(io.StringIO(label), delimiter=',', quotechar='"')
+                  for csv_label in csv_line]
+        labels = [label.replace(":", "_") for label in labels
+                  if not self.category_re.match(label) and not self.imap_re.match(label)]
+
+        if self.opened in labels:
+            labels.remove(self.opened)
+
+        if "INBOX" in labels:
+            labels.remove("INBOX")
+
+        flags = []
+        if self.unread in labels:
+            labels.remove(self.unread)
+        else:
+            flags.append('\\Seen')
+
+        if self.important in labels:
+            flags.append('\\Flagged')
+            labels.remove(self.important)
+
+        if self.sent in labels and len(labels) > 1:
+            labels.remove(self.sent)
+
+        if self.trash in labels:
+            labels.remove(self.trash)
+            labels.append('Trash')
+
+        boxes = []
+        if labels:
+            flags = " ".join(flags)
+            if self.draft in labels:
+                boxes.append(['Drafts'])
+            elif 'Spam' in labels:
+                boxes.append(['Junk'])
+            else:
+                boxes.extend(label.replace("?", "").split("/") for label in labels)
+        else:
+            flags = []
+        if not boxes:
+            boxes.append(["INBOX"])
+        if self.first_label:
+            boxes = [self.get_label_by_prio(boxes)]
+        return flags, tuple(tuple(box) for box in boxes)
+
+    def get_label_by_prio(self, labels):
+        labels = [label[0] for label in labels]
+        for label in self.label_priority:
+            if label in labels:
+                return [label]
+        # prevent using label Archive, if others are available
+        if labels[0] == "Archived" and len(labels) > 1:
+            return [labels[1]]
+        # return fist label if we do not have other hints
+        return [labels[0]]
 
 
 class Progress():
     """Store and output progress information."""
 
-    def __init__(self, total_count, google_takeout=False, google_takeout_first_label=False,
-                 google_takeout_label_priority=None, google_takeout_language="en"):
-        self.total_count = total_count
+    def __init__(self, total_bytes, google_takeout=False, google_takeout_first_label=False,
+                 google_takeout_label_priority=None, google_takeout_language="en", metrics=None, quiet=False,
+                 name=None, tree=None):
+        self.total_bytes = total_bytes
+        # With -r, the Progress of all the mboxes together, which the rates
+        # and ETA printed are those of.
+        self.tree = tree
+        self.lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else Metrics()
+        # The metrics may be shared with the uploads of other mboxes.
+        self.reconnects_before = self.metrics.counters["reconnects"]
+        self.reconnect_seconds_before = self.metrics.seconds("reconnect")
+        self.throttled_before = self.metrics.counters["throttled"]
+        self.throttle_seconds_before = self.metrics.seconds("throttle")
+        # Only print the lines of the messages that failed.
+        self.quiet = quiet
+        # Filled in by the background counter once it has gone through the
+        # whole mbox; until then the total is estimated from the position.
+        self.total_count = None
         self.ok_count = 0
         self.warning_count = 0
+        self.error_count = 0
+        self.skipped_count = 0
+        # Messages tried again after the others, counted once done.
+        self.retried_count = 0
         self.count = 0
-        self.format = "%" + str(len(str(total_count))) + "d/" + \
-                      str(total_count) + " %5.1f %-2s  %s  "
+        self.time_started = time.time()
+        # Where this run started, to compute the rates: messages before it
+        # may have been uploaded by an earlier run.
+        self.start_count = 0
+        self.start_position = None
+        self.position = 0
+        self.format = "%6d/%-7s %5.1f %-2s %s  %s  "
+        # Tells the lines of mboxes uploaded at once apart.
+        self.name = name
+        if name is not None:
+            self.format = name.replace("%", "%%") + ": " + self.format
         self.google_takeout = google_takeout
-        self.google_takeout_first_label = google_takeout_first_label
-        self.google_takeout_label_priority = google_takeout_label_priority
-        self.google_takeout_language = google_takeout_language
+        if google_takeout:
+            self.labels = TakeoutLabels(google_takeout_language, google_takeout_first_label,
+                                        google_takeout_label_priority)
 
     def begin(self, msg):
-        """Called when start processing of a new message."""
-        self.time_began = time.time()
-        size, prefix = si_prefix(float(len(ImapUploadMessage.as_string(msg))), threshold=0.8)
+        """Called when start processing of a new message.
+
+        Nothing is printed yet: the line of a message is printed by the
+        end methods, as several messages may be in flight at once.
+        """
+        msg.time_began = time.time()
+        # The destination box, for the metrics.
+        msg.target = None
+        if self.start_position is None:
+            self.start_position = msg.source_span()[0]
+            # Before it, what an earlier run uploaded.
+            if self.start_position > self.position:
+                self.move(self.start_position, earlier=True)
+        msg.size = si_prefix(float(len(msg.data)), threshold=0.8)
+        if isinstance(msg.prepared, Exception):
+            msg.description = ""
+            raise msg.prepared
+        if msg.prepared is not None:
+            msg.description, msg.flags, msg.boxes = msg.prepared[:3]
+            return
+        msg.description = ""
         sbj = decode_header_to_string(msg["subject"] or "")
+        msg.description = '{:30.30}'.format(remove_control_chars(sbj))
         if self.google_takeout:
-            if (self.google_takeout_language == "en"):
-                gmail_inbox_str = r"Inbox"
-                gmail_sent_str = r"Sent"
-                gmail_draft_str = "Draft"
-                gmail_important_str = u'Important'
-                gmail_open_str = u'Open'
-                gmail_unseen_str = u"Unread"
-                gmail_category_str = r"^Category_"
-                gmail_imap_str = r'^IMAP_'
-                gmail_trash_str = "Trash"
-            elif (self.google_takeout_language == "es"):
-                gmail_inbox_str = r"Recibidos"
-                gmail_sent_str = r"Enviados"
-                gmail_draft_str = "Borradores"
-                gmail_important_str = u'Importante'
-                gmail_open_str = u'Abierto'
-                gmail_unseen_str = u"No leídos"
-                gmail_category_str = r"^Categor.a:"
-                gmail_imap_str = r'^IMAP_'
-                gmail_trash_str = "Papelera"
-            elif (self.google_takeout_language == "ca"):
-                gmail_inbox_str = r"Safata d'entrada"
-                gmail_sent_str = r"Enviats"
-                gmail_draft_str = "Esborranys"
-                gmail_important_str = u'Importants'
-                gmail_open_str = u'Oberts'
-                gmail_unseen_str = u"No llegits"
-                gmail_category_str = r"^Categor.a"
-                gmail_imap_str = r'^IMAP_'
-                gmail_trash_str = "Paperera"
-            elif (self.google_takeout_language == "de"):
-                gmail_inbox_str = r"Posteingang"
-                gmail_sent_str = r"Gesendet"
-                gmail_draft_str = "Entwürfe"
-                gmail_important_str = u'Wichtig'
-                gmail_open_str = u'Geöffnet'
-                gmail_unseen_str = u"Ungelesen"
-                gmail_category_str = r"^Kategorie_"
-                gmail_imap_str = r'^IMAP_'
-                gmail_trash_str = "Papierkorb"
-            label = decode_header_to_string(msg["x-gmail-labels"] or "")
-            sanitized_label = re.sub(r"\n\r", "", label)
-            sanitized_label = re.sub(r"\r\n", "", sanitized_label)
-            sanitized_label = re.sub(r"\r", " ", sanitized_label)
-            sanitized_label = re.sub(r"\n", "", sanitized_label)
-            label = sanitized_label
-            label = re.sub(gmail_inbox_str, "INBOX", label)
-            label = re.sub(gmail_sent_str, "Sent", label)
-
-            csv_file = io.StringIO(label)
-            csv_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-            labels = []
-            for csv_line in csv_reader:
-                for csv_label in csv_line:
-                    labels.append(csv_label)
-
-            labels_without_categories = []
-            for i in range(len(labels)):
-                if (not (re.match(gmail_category_str,labels[i]))):
-                    labels_without_categories.append(labels[i])
-
-            labels = labels_without_categories
-
-            labels_without_special_imap_dirs = []
-            for i in range(len(labels)):
-                if (not (re.match(gmail_imap_str,labels[i]))):
-                    labels_without_special_imap_dirs.append(labels[i])
-
-            labels = labels_without_special_imap_dirs
-
-            sanitized_labels = []
-            for i in range(len(labels)):
-                sanitized_label = re.sub(r":", "_", labels[i])
-                sanitized_labels.append(sanitized_label)
-            labels = sanitized_labels
-
-            if labels.count(gmail_open_str) > 0:
-                labels.remove(gmail_open_str)
-
-            if labels.count(u'INBOX') > 0:
-                labels.remove(u'INBOX')
-
-            flags = []
-            if labels.count(gmail_unseen_str) > 0:
-                labels.remove(gmail_unseen_str)
-            else:
-                flags.append('\Seen')
-
-            if labels.count(gmail_important_str) > 0:
-                flags.append('\Flagged')
-                labels.remove(gmail_important_str)
+            msg.flags, msg.boxes = self.labels.lookup(msg["x-gmail-labels"] or "")
+            msg.description += "   to [%s]" % (",".join(x[0] for x in msg.boxes))
 
-            if ((labels.count(gmail_sent_str) > 0) and (len(labels) > 1)):
-                labels.remove(gmail_sent_str)
-
-            if labels.count(gmail_trash_str) > 0:
-                labels.remove(gmail_trash_str)
-                labels.append('Trash')
-
-            if len(labels):
-                msg.flags = " ".join(flags)
-            else:
-                msg.flags = []
-
-            msg.boxes = []
-            if len(labels) != 0:
-                if labels.count(gmail_draft_str):
-                    msg.boxes.append(['Drafts'])
-                else:
-                    if labels.count('Spam'):
-                        msg.boxes.append(['Junk'])
-                    else:
-                        for i in range(len(labels)):
-                            box = re.sub(r"\?", "", labels[i])
-                            msg.boxes.append(box.split("/"))
-            if len(msg.boxes) == 0:
-                msg.boxes.append(["INBOX"])
-            if self.google_takeout_first_label:
-                only_label = self.get_label_by_prio(msg.boxes)
-                msg.boxes = []
-                msg.boxes.append(only_label)
-
-            print(self.format % \
-                  (self.count + 1, size, prefix + "B", '{:30.30}'.format(remove_control_chars(sbj))),
-                  "to [%s]" % (",".join(x[0] for x in msg.boxes)), end=' ')
-        else:
-            print(self.format % \
-                (self.count + 1, size, prefix + "B", '{:30.30}'.format(remove_control_chars(sbj))), end=' ')
+    def end(self, msg, status, outcome):
+        """Account for msg and print its line, ending with outcome."""
+        self.count += 1
+        if self.tree is not None:
+            self.tree.add(1, 0)
+        self.advance(msg)
+        self.metrics.count_message(msg.target, status, len(msg.data))
+        if self.quiet and status in ("ok", "skipped"):
+            return
+        self.print_line(msg, outcome)
+
+    def advance(self, msg):
+        # The messages tried again come after the others: keep the position.
+        self.move(max(self.position, msg.source_span()[1]))
+
+    def move(self, position, earlier=False):
+        """Set the position, moving that of the tree as much."""
+        if self.tree is not None:
+            self.tree.add(0, position - self.position, earlier)
+        self.position = position
+
+    def add(self, count, size, earlier=False):
+        """Account for count messages and size bytes more, of one of the mboxes of the tree.
+
+        earlier is set for those an earlier run uploaded.
+        """
+        with self.lock:
+            self.count += count
+            self.position += size
+            if earlier:
+                self.start_count += count
+                self.start_position += size
+
+    def print_line(self, msg, outcome):
+        size, prefix = msg.size
+        print(self.format % \
+              (self.count, self.format_total(), size, prefix + "B", self.format_rates(),
+               msg.description), outcome)
+
+    def resume(self, count, position=None):
+        """Called when count messages up to position were uploaded earlier.
+
+        position is None when it is not known before reading on.
+        """
+        if self.tree is not None:
+            self.tree.add(count - self.count, 0, earlier=True)
+        self.count = self.start_count = count
+        if position is not None:
+            self.move(position, earlier=True)
+            self.start_position = position
+
+    def skip(self, msg):
+        """Called for a message that does not need to be uploaded."""
+        start, position = msg.source_span()
+        self.move(position)
+        if self.start_position is None:
+            self.start_position = start
+        self.count += 1
+        if self.tree is not None:
+            self.tree.add(1, 0)
+        self.skipped_count += 1
+        self.metrics.count_message(None, "skipped", len(msg.data))
 
-    def get_label_by_prio(self, labels):
-        labels = [label[0] for label in labels]
-        for label in self.google_takeout_label_priority:
-            if label in labels:
-                return [label]
-        # prevent using label Archive, if others are available
-        if labels[0] == "Archived" and len(labels) > 1:
-            return [labels[1]]
-        # return fist label if we do not have other hints
-        return [labels[0]]
+    def set_total_count(self, total_count):
+        """Called by the background counter when the mbox has been counted."""
+        self.total_count = total_count
 
-    def endOk(self):
+    def format_total(self):
+        if self.total_count is not None:
+            return str(self.total_count)
+        if self.count == self.start_count or self.position <= self.start_position:
+            return "?"
+        # Estimate from the average size of the messages seen so far.
+        done = self.position - self.start_position
+        return "~%d" % (self.start_count +
+                        (self.count - self.start_count) * (self.total_bytes - self.start_position) / done)
+
+    def format_rates(self):
+        """Return message and byte rates and the ETA based on the position."""
+        if self.tree is not None:
+            return self.tree.format_rates()
+        elapsed = time.time() - self.time_started
+        done = self.position - (self.start_position or 0)
+        if elapsed <= 0 or done <= 0:
+            return "[%5.1f%% %6s msg/s %5s %3s/s ETA %7s]" % (0.0, "-", "-", "B", "-")
+        byte_rate, prefix = si_prefix(done / elapsed, threshold=0.8)
+        eta = (self.total_bytes - self.position) / (done / elapsed)
+        return "[%5.1f%% %6.1f msg/s %5.1f %3s/s ETA %7s]" % \
+            (100.0 * self.position / max(self.total_bytes, 1), (self.count - self.start_count) / elapsed,
+             byte_rate, prefix + "B", format_duration(eta))
+
+    def endOk(self, msg):
         """Called when a message was processed successfully."""
-        self.count += 1
         self.ok_count += 1
-        print("OK (%d sec)" % \
-              math.ceil(time.time() - self.time_began))
+        self.end(msg, "ok", "OK (%d sec)" % \
+                 math.ceil(time.time() - msg.time_began))
 
-    def endError(self, err):
+    def endError(self, msg, err):
         """Called when an error has occurred while processing a message."""
-        print("ERROR (%s)" % err)
+        self.error_count += 1
+        self.end(msg, "error", "ERROR (%s)" % err)
 
-    def endWarning(self, err):
+    def endWarning(self, msg, err):
         """Called when a warning has occurred while processing a message."""
         self.warning_count += 1
-        print("WARNING (%s)" % err)
+        self.end(msg, "warning", "WARNING (%s)" % err)
+
+    def endSkipped(self, msg, reason):
+        """Called when a message was not uploaded, on purpose."""
+        self.skipped_count += 1
+        self.end(msg, "skipped", "SKIPPED (%s)" % reason)
+
+    def endDeferred(self, msg, err):
+        """Called when a message failed, to be tried again after the others."""
+        self.retried_count += 1
+        self.advance(msg)
+        self.metrics.count("deferred")
+        self.print_line(msg, "RETRY LATER (%s)" % err)
 
-    def endAll(self):
+    def endAll(self, compression=None):
         """Called when all message was processed."""
-        print("Done. (OK: %d, WARNING: %d, ERROR: %d)" % \
-              (self.ok_count, self.warning_count, (self.total_count - self.ok_count - self.warning_count)))
+        elapsed = time.time() - self.time_started
+        if self.name is not None:
+            print(self.name + ":", end=' ')
+        print("Done. (OK: %d, WARNING: %d, ERROR: %d, SKIPPED: %d) in %s" % \
+              (self.ok_count, self.warning_count, self.error_count, self.skipped_count,
+               format_duration(elapsed)))
+        if self.retried_count:
+            print("Tried %d messages again after the others" % self.retried_count)
+        if compression is not None and compression.sent_deflated:
+            print("Compression: %s" % compression)
+        reconnects = self.metrics.counters["reconnects"] - self.reconnects_before
+        if reconnects:
+            print("Reconnected %d times, after waiting %.1f sec in all" %
+                  (reconnects, self.metrics.seconds("reconnect") - self.reconnect_seconds_before))
+        throttled = self.metrics.counters["throttled"] - self.throttled_before
+        if throttled:
+            print("Slowed down %d times for the server, waiting %.1f sec in all" %
+                  (throttled, self.metrics.seconds("throttle") - self.throttle_seconds_before))
 
 
 def upload(imap, box, src, err, time_fields, google_takeout=False, google_takeout_first_label=False,
            google_takeout_label_priority=None, google_takeout_box_as_base_folder=False, google_takeout_language="en",
-           debug=False, maximum_size_exceeded_are_warnings=False):
+           debug=False, maximum_size_exceeded_are_warnings=False, batch_size=1, batch_bytes=1024 * 1024,
+           resume=False, skip_existing=False, metrics=None, quiet=False, name=None, parse_workers=0,
+           retry_backoff=None, targets=None, tree=None):
+    """Upload the messages of the mbox src to box; return its Progress.
+
+    The messages that fail for a transient reason, such as a lost connection
+    or a server asking to slow down, are tried again once the others are
+    done, after a wait given by retry_backoff. Those that fail again are then written to
+    err all at once. With targets, the ErrorMbox.targets() of src, each
+    message goes to the boxes it failed to be uploaded to before.
+    """
     print("Uploading to {}...".format(box))
-    print("Counting the mailbox (it could take a while for the large one).")
-    p = Progress(len(src), google_takeout=google_takeout, google_takeout_first_label=google_takeout_first_label,
+    if metrics is None:
+        metrics = imap.metrics
+    p = Progress(src.size, google_takeout=google_takeout, google_takeout_first_label=google_takeout_first_label,
                  google_takeout_label_priority=google_takeout_label_priority,
-                 google_takeout_language=google_takeout_language)
-    for i, msg in src.iteritems():
-        maximumMessageSizeWarning = False
+                 google_takeout_language=google_takeout_language, metrics=metrics, quiet=quiet, name=name,
+                 tree=tree)
+    # Count the messages in the background so that uploading starts at once.
+    # A compressed mbox would be decompressed twice for that.
+    counting_done = threading.Event()
+    if src.random_access:
+        threading.Thread(target=count_messages, args=(src.path, p, counting_done), daemon=True).start()
+    start = 0
+    journal = None
+    if resume:
+        journal = UploadJournal(src.path + ".journal", src.path)
+        start, done = journal.resume_position(src)
+        if start:
+            print("Resuming after {} messages...".format(done))
+            p.resume(done, start if src.random_access else None)
+    existing = ExistingMessages(imap, box) if skip_existing else None
+    if retry_backoff is None:
+        retry_backoff = RetryBackoff()
+    # (offset, (msg_boxes, flags)) of the messages that failed.
+    failed = [] if err is not None else None
+    deferred = collections.deque()
+
+    def again():
+        # In mbox order, for a compressed mbox to be read once.
+        ordered = sorted(deferred, key=lambda item: item[0])
+        deferred.clear()
+        deferred.extend(ordered)
+        for msg in src.messages_at([offset for offset, destination in ordered]):
+            msg.destination = deferred.popleft()[1]
+            yield msg
+
+    def upload_all(messages, deferred):
+        if targets is not None:
+            messages = replayed_messages(messages, box, targets, p, time_fields)
+        upload_messages(imap, box, messages, p, failed, deferred, journal, existing, time_fields,
+                        google_takeout or targets is not None, google_takeout_box_as_base_folder, debug,
+                        maximum_size_exceeded_are_warnings, batch_size, batch_bytes)
+
+    try:
+        # A compressed mbox is decompressed once: its folders are created
+        # as the labels of its messages come instead.
+        plan_as_read = google_takeout and targets is None and not src.random_access
+        with p.metrics.timer("plan"):
+            if targets is not None:
+                imap.plan_folders(replayed_boxes(box, targets))
+            elif not plan_as_read:
+                imap.plan_folders(destination_boxes(box, src, start, p, google_takeout,
+                                                    google_takeout_box_as_base_folder))
+        if parse_workers and targets is None and src.random_access:
+            messages = prepared_messages(src, start, parse_workers, time_fields, dict(
+                google_takeout=google_takeout, google_takeout_first_label=google_takeout_first_label,
+                google_takeout_label_priority=google_takeout_label_priority,
+                google_takeout_language=google_takeout_language))
+        elif plan_as_read:
+            messages = planned_messages(imap, box, src.messages(start), p, google_takeout_box_as_base_folder)
+        else:
+            messages = src.messages(start)
+        upload_all(messages, deferred)
+        if deferred:
+            delay = retry_backoff.next_delay()
+            print("Trying the {} messages that failed again in {:.1f} sec...".format(len(deferred), delay))
+            with p.metrics.timer("retry"):
+                time.sleep(delay)
+            stored = p.ok_count
+            upload_all(again(), None)
+            if p.ok_count > stored:
+                retry_backoff.reset()
+    finally:
+        counting_done.set()
+        # Also those not tried again, if interrupted.
+        if failed is not None and (failed or deferred):
+            destinations = dict(itertools.chain(failed, deferred))
+            with p.metrics.timer("error_mbox"):
+                err.add(box, ((msg, destinations[msg.offset]) for msg in src.messages_at(sorted(destinations))))
+        if journal is not None:
+            journal.close()
+    p.endAll(imap.compression)
+    return p
+
+
+# The Progress a worker process of prepared_messages() parses messages with,
+# made once by start_parse_worker() so that its TakeoutLabels cache lasts.
+parse_worker_progress = None
+
+def start_parse_worker(progress_options):
+    """Set up a worker process of prepared_messages()."""
+    global parse_worker_progress
+    parse_worker_progress = Progress(0, **progress_options)
+
+
+def prepare_messages(path, start, stop, time_fields):
+    """Parse the messages of the mbox at path from offset start to stop.
+
+    Runs in a worker process of prepared_messages(). Return the prepared
+    attribute of each message, in order; stop is -1 for the end of the mbox.
+    That of a message that could not be parsed is the exception raised, for
+    Progress.begin() to raise again.
+    """
+    p = parse_worker_progress
+    src = MboxReader(path)
+    try:
+        prepared = []
+        for msg in src.messages(start):
+            if stop != -1 and msg.offset >= stop:
+                break
+            try:
+                p.begin(msg)
+                prepared.append((msg.description, getattr(msg, "flags", None), getattr(msg, "boxes", None),
+                                 msg.get_delivery_time(time_fields)))
+            except Exception as e:
+                prepared.append(picklable_exception(e))
+        return prepared
+    finally:
+        src.close()
+
+
+def picklable_exception(e):
+    """Return e, or an Exception with its message if e cannot be sent to another process."""
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return Exception("{}: {}".format(type(e).__name__, e))
+
+
+def prepared_messages(src, start, workers, time_fields, progress_options, chunk_bytes=4 * 1024 * 1024):
+    """Yield the messages of src from offset start on, parsed by worker processes.
+
+    The mbox is cut at From_ lines into ranges of about chunk_bytes, each
+    parsed by prepare_messages() in one of workers processes, with up to two
+    ranges per worker waiting. The messages themselves are yielded in mbox
+    order from src, which the workers need not send back.
+
+    The workers are started afresh rather than forked, for a fork would copy
+    the threads and connections of the uploaders.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn"),
+        initializer=start_parse_worker, initargs=(progress_options,))
+    pending = collections.deque()
+    start = src.first_boundary(start)
+    try:
+        while start != -1 or pending:
+            while start != -1 and len(pending) < 2 * workers:
+                stop = src.first_boundary(start + chunk_bytes)
+                pending.append((start, stop, executor.submit(
+                    prepare_messages, src.path, start, stop, time_fields)))
+                start = stop
+            range_start, range_stop, future = pending.popleft()
+            prepared = iter(future.result())
+            for msg in src.messages(range_start):
+                if range_stop != -1 and msg.offset >= range_stop:
+                    break
+                msg.prepared = next(prepared)
+                yield msg
+    finally:
+        # The ranges not parsed yet are not needed any more. Cancelled
+        # here, for shutdown() only takes cancel_futures from Python 3.9.
+        for range_start, range_stop, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def replayed_boxes(box, targets):
+    """Return the boxes the messages of an --error mbox with targets go to."""
+    boxes = {box}
+    for target in targets.values():
+        boxes.update(target["box"] if msg_box is None else tuple(msg_box) for msg_box in target["boxes"])
+    return [msg_box if isinstance(msg_box, str) else list(msg_box) for msg_box in boxes]
+
+
+def replayed_messages(messages, box, targets, p, time_fields):
+    """Yield messages of an --error mbox, with the flags and boxes of targets.
+
+    The boxes of each message are given the way Google Takeout labels are;
+    messages that targets does not know go to box.
+    """
+    for msg in messages:
+        target = targets.get(UploadJournal.hash(msg), {"box": box, "boxes": [None], "flags": None})
+        p.begin(msg)
+        boxes = [[target["box"]] if msg_box is None else msg_box for msg_box in target["boxes"]]
+        msg.prepared = (msg.description, target["flags"], boxes, msg.get_delivery_time(time_fields))
+        yield msg
+
+
+def destination_boxes(box, src, start, p, google_takeout, google_takeout_box_as_base_folder):
+    """Return the boxes the messages of src from position start go to.
+
+    Without google_takeout, that is box. Otherwise each distinct
+    X-Gmail-Labels header of the messages is read once, without parsing
+    the rest of the messages.
+    """
+    if not google_takeout:
+        return [box]
+    boxes = set()
+    headers = set()
+    for msg in src.messages(start):
+        header = msg["x-gmail-labels"] or ""
+        if header in headers:
+            continue
+        headers.add(header)
+        boxes.update(tuple(msg_box) for msg_box in label_boxes(box, header, p, google_takeout_box_as_base_folder))
+    return [list(msg_box) for msg_box in boxes]
+
+
+def label_boxes(box, header, p, google_takeout_box_as_base_folder):
+    """Return the boxes the X-Gmail-Labels header of a message sends it to."""
+    boxes = p.labels.lookup(header)[1]
+    if google_takeout_box_as_base_folder:
+        boxes = [[box] + msg_box for msg_box in boxes]
+    return boxes
+
+
+def planned_messages(imap, box, messages, p, google_takeout_box_as_base_folder):
+    """Yield messages, creating the folders of each new X-Gmail-Labels header first.
+
+    That is for a mbox read only once, which destination_boxes() would
+    read whole before the upload starts.
+    """
+    headers = set()
+    for msg in messages:
+        header = msg["x-gmail-labels"] or ""
+        if header not in headers:
+            headers.add(header)
+            with p.metrics.timer("plan"):
+                imap.plan_folders(label_boxes(box, header, p, google_takeout_box_as_base_folder))
+        yield msg
+
+
+# The bytes of the messages done, but not reported yet for an older one is
+# still being sent, that upload_messages() keeps before waiting for it.
+report_backlog_bytes = 64 * 1024 * 1024
+
+
+def upload_messages(imap, box, messages, p, failed, deferred, journal, existing, time_fields, google_takeout,
+                    google_takeout_box_as_base_folder, debug, maximum_size_exceeded_are_warnings,
+                    batch_size, batch_bytes):
+    """Upload messages to box, reporting each of them to p and journal.
+
+    Unless existing is None, messages are not sent to the boxes it has
+    them in already. Messages larger than the server accepts are not sent
+    at all, but reported as if the server had refused them. The messages
+    that fail are added to failed or deferred, as report_upload() tells.
+    """
+    # Messages handed to imap and not reported yet, oldest first, with the
+    # bytes they hold. They are reported in mbox order, whatever order they
+    # complete in.
+    pending = collections.deque()
+    # Up to imap.window of the other messages are in flight at once, oldest
+    # first. The large messages, which imap sends on a lane of their own,
+    # are not counted: the small ones behind one keep flowing meanwhile, as
+    # long as those done take up less than report_backlog_bytes.
+    in_flight = collections.deque()
+    backlog = 0
+    # Consecutive small messages for the same boxes, sent with MULTIAPPEND.
+    batching = batch_size > 1 and imap.supports("MULTIAPPEND")
+    batch = []
+    batch_boxes = None
+    limit = imap.append_limit
+    for msg in messages:
+        if journal is not None and journal.check_each and journal.uploaded(msg):
+            p.skip(msg)
+            continue
+        future = concurrent.futures.Future()
+        large = False
         try:
-            p.begin(msg)
+            with p.metrics.timer("parse"):
+                p.begin(msg)
             if google_takeout:
                 if google_takeout_box_as_base_folder:
                     msg_boxes = []
@@ -471,85 +1149,439 @@ def upload(imap, box, src, err, time_fields, google_takeout=False, google_takeou
                         msg_boxes.append(msg_box)
                 else:
                     msg_boxes = msg.boxes
-                for i in range(len(msg_boxes)):
-                    r, r2 = imap.upload(box, msg.get_delivery_time(time_fields),
-                                        ImapUploadMessage.as_string(msg), msg.flags, msg_boxes[i], 3)
-                    if r != "OK":
-                        raise Exception(r2[0]) # FIXME: Should use custom class
+                flags = msg.flags
             else:
-                r, r2 = imap.upload(box, msg.get_delivery_time(time_fields),
-                                    ImapUploadMessage.as_string(msg), None, None, 3)
-                if r != "OK":
-                    raise Exception(r2[0]) # FIXME: Should use custom class
-
-            p.endOk()
-            continue
-        except socket.error as e:
-            p.endError("Socket error: " + str(e))
-        except Exception as e:
-            maximumMessageSizeWarning = maximum_size_exceeded_are_warnings and re.search(r'maximum message size exceeded', repr(e))
-            if (maximumMessageSizeWarning):
-                if debug:
-                    p.endWarning(traceback.format_exc())
+                msg_boxes = [None]
+                flags = None
+            if msg.destination is not None:
+                # Tried again: only to the boxes it did not go to before.
+                msg_boxes, flags = msg.destination
+            msg.target = box if msg_boxes[0] is None else "/".join(msg_boxes[0])
+            if existing is not None:
+                msg_boxes = [msg_box for msg_box in msg_boxes if not existing.has(msg_box, msg)]
+                if not msg_boxes:
+                    raise AlreadyUploaded()
+            msg.destination = (msg_boxes, flags)
+            key = box if msg_boxes[0] is None else "/".join(msg_boxes[0])
+            with p.metrics.timer("date"):
+                if msg.prepared is not None:
+                    delivery_time = msg.prepared[3]
                 else:
-                    p.endWarning(e)
+                    delivery_time = msg.get_delivery_time(time_fields)
+            with p.metrics.timer("serialize"):
+                literal = crlf_lines(msg.data)
+            if limit is not None and len(literal) > limit:
+                raise MessageTooLarge(len(literal), limit)
+            if batch and (msg_boxes != batch_boxes or len(batch) >= batch_size or
+                          sum(len(l) for m, f, d, fl, l in batch) + len(literal) > batch_bytes):
+                submit_batch(imap, box, batch_key, batch, batch_boxes)
+                batch = []
+            # In bytes sent: the literals, with their CRLF line endings.
+            if batching and len(literal) <= batch_bytes:
+                batch.append((msg, future, delivery_time, flags, literal))
+                batch_key = key
+                batch_boxes = msg_boxes
             else:
-                if debug:
-                    p.endError(traceback.format_exc())
-                else:
-                    p.endError(e)
-        if ((err is not None) and (not maximumMessageSizeWarning)):
-            err.add(msg)
-    p.endAll()
-
-
-def recursive_upload(imap, box, src, err, time_fields, email_only_folders, separator, debug=False):
-    usrc = str(src)
-    if debug: print("Visiting directory %s" % (usrc))
-    for file in os.listdir(usrc):
-        path = usrc + os.sep + file
-        if os.path.isdir(path):
-            fileName, fileExtension = os.path.splitext(file)
-            if not box:
-                subbox = fileName
-            else:
-                subbox = box + separator + fileName
-            recursive_upload(imap, subbox, path, err, time_fields, email_only_folders, separator, debug)
-        elif file.endswith("mbox"):
-            print("Found mailbox at {}...".format(path))
-            mbox = mailbox.mbox(path, create=False)
-            if (email_only_folders and has_mixed_content(src)):
-                target_box = box + separator + src.split(os.sep)[-1]
+                large = imap.large_lane(len(literal))
+                future = imap.submit(key, functools.partial(
+                    append_message, box=box, delivery_time=delivery_time,
+                    message=literal, flags=flags, msg_boxes=msg_boxes), len(literal))
+        except Exception as e:
+            future.set_exception(e)
+        size = 0 if large else len(msg.data)
+        pending.append((msg, future, size))
+        backlog += size
+        if not large:
+            in_flight.append(future)
+        while True:
+            while in_flight and in_flight[0].done():
+                in_flight.popleft()
+            if pending and pending[0][1].done():
+                msg, future, size = pending.popleft()
+                backlog -= size
+                report_upload(p, msg, future, failed, deferred, journal, debug, maximum_size_exceeded_are_warnings)
+                continue
+            # The messages of the batch being filled are not submitted yet.
+            if len(in_flight) - len(batch) > imap.window:
+                oldest = in_flight[0]
+            elif backlog > report_backlog_bytes:
+                oldest = pending[0][1]
             else:
-                target_box = file.split('.')[0] if (box is None or box == "") else box
-            if err:
-                err = mailbox.mbox(err)
-            upload(imap, target_box, mbox, err, time_fields)
-        elif file.endswith(".msf"):
-            print("Found Thunderbird mailbox at {}...".format(path))
-            mbox = mailbox.mbox(path.replace(".msf",""), create=False)
-            if (email_only_folders and has_mixed_content(src)):
-                target_box = box + separator + src.split(os.sep)[-1]
+                break
+            # The batch may be all that is left to wait for: it is sent first.
+            if batch and oldest is batch[0][1]:
+                submit_batch(imap, box, batch_key, batch, batch_boxes)
+                batch = []
+            concurrent.futures.wait((oldest,))
+    if batch:
+        submit_batch(imap, box, batch_key, batch, batch_boxes)
+    while pending:
+        msg, future, size = pending.popleft()
+        report_upload(p, msg, future, failed, deferred, journal, debug, maximum_size_exceeded_are_warnings)
+
+
+def append_message(uploader, box, delivery_time, message, flags, msg_boxes):
+    """Append message to each of msg_boxes using uploader.
+
+    If the server supports UIDPLUS, the message is only sent to the first
+    box; it is then copied on the server to the other ones. Return the
+    UIDVALIDITY and UID of the message in the first box, if known. If it
+    fails, the exception raised has the boxes the message is not in yet as
+    missing_boxes.
+    """
+    appended = None
+    for i, msg_box in enumerate(msg_boxes):
+        try:
+            if appended is not None and copy_appended(uploader, box, appended, msg_box):
+                continue
+            r, r2 = uploader.upload(box, delivery_time, message, flags, msg_box, 3)
+            if r != "OK":
+                raise Exception(r2[0]) # FIXME: Should use custom class
+        except Exception as e:
+            e.missing_boxes = msg_boxes[i:]
+            raise
+        if appended is None:
+            appended = appended_uids(uploader, msg_box, r2)
+    return appended and appended[1:]
+
+
+appenduid_re = re.compile(br"\[APPENDUID (\d+) ([0-9:,]+)\]")
+
+def appended_uids(uploader, msg_box, data):
+    """Return what copy_appended() needs to copy what was just appended.
+
+    That is (msg_box, UIDVALIDITY, UID set) from the APPENDUID response
+    code (RFC 4315), or None if the server does not tell.
+    """
+    if not uploader.supports("UIDPLUS"):
+        return None
+    m = appenduid_re.search(data[0]) if data and isinstance(data[0], bytes) else None
+    if m is None:
+        return None
+    return msg_box, m.group(1), m.group(2)
+
+
+def expand_uid_set(uids):
+    """Return the list of the UIDs of an UID set such as b"4,7:9"."""
+    expanded = []
+    for part in uids.split(b","):
+        first, sep, last = part.partition(b":")
+        expanded.extend(b"%d" % uid for uid in range(int(first), int(last or first) + 1))
+    return expanded
+
+
+def copy_appended(uploader, box, appended, msg_box):
+    """Copy messages appended before to msg_box; tell whether it worked."""
+    try:
+        r, r2 = uploader.copy(box, appended, msg_box, 3)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error:
+        return False
+    return r == "OK"
+
+
+def submit_batch(imap, box, key, batch, msg_boxes):
+    """Submit batch, a list of (msg, future, delivery_time, flags, literal), as one job.
+
+    The future of each message is completed with its own outcome.
+    """
+    futures = [future for msg, future, delivery_time, flags, literal in batch]
+
+    def dispatch(job):
+        e = job.exception()
+        outcomes = [e] * len(futures) if e is not None else job.result()
+        for future, outcome in zip(futures, outcomes):
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
             else:
-                target_box = file.split('.')[0] if (box is None or box == "") else box
-            if err:
-                err = mailbox.mbox(err)
-            upload(imap, target_box, mbox, err, time_fields)
-        else:
-            print("Skipping unknown file (no mbox ending): %s" % (file))
+                future.set_result(outcome)
 
-def has_mixed_content(src):
-    dirFound = False
-    mboxFound = False
+    job = imap.submit(key, functools.partial(
+        append_batch, box=box,
+        messages=[(flags, delivery_time, literal) for msg, future, delivery_time, flags, literal in batch],
+        msg_boxes=msg_boxes))
+    job.add_done_callback(dispatch)
 
-    for file in os.listdir(src):
-        path = src + os.sep + file
-        if (os.path.isdir(path)):
-            dirFound = True
-        elif file.endswith("mbox"):
-            mboxFound = True
 
-    return dirFound and mboxFound
+def append_batch(uploader, box, messages, msg_boxes):
+    """Append messages to each of msg_boxes with MULTIAPPEND.
+
+    If the server rejects the batch, its messages are appended one by one
+    instead, so that only the faulty ones fail. Return the outcome of each
+    message: its UIDVALIDITY and UID (or None) when it was appended, the
+    exception otherwise, with missing_boxes as append_message() gives it.
+    """
+    appended = None
+    for i, msg_box in enumerate(msg_boxes):
+        try:
+            if appended is not None and copy_appended(uploader, box, appended, msg_box):
+                continue
+            r, r2 = uploader.upload_batch(box, messages, msg_box, 3)
+        except imaplib.IMAP4.abort as e:
+            e.missing_boxes = msg_boxes[i:]
+            raise
+        except imaplib.IMAP4.error:
+            r = "BAD"
+        if r != "OK":
+            break
+        if appended is None:
+            appended = appended_uids(uploader, msg_box, r2)
+    else:
+        if appended is not None:
+            uids = expand_uid_set(appended[2])
+            if len(uids) == len(messages):
+                return [(appended[1], uid) for uid in uids]
+        return [None] * len(messages)
+    outcomes = []
+    for flags, delivery_time, message in messages:
+        try:
+            outcomes.append(append_message(uploader, box, delivery_time, message, flags, msg_boxes[i:]))
+        except Exception as e:
+            outcomes.append(e)
+    return outcomes
+
+
+def report_upload(p, msg, future, failed, deferred, journal, debug, maximum_size_exceeded_are_warnings):
+    """Wait for the upload of msg and report its outcome.
+
+    If msg failed, its offset and the boxes and flags it was uploaded with
+    are added to deferred, to be tried again later, if the failure is
+    transient (see transient_failure()) and deferred is not None. They are
+    added to failed, if not None, otherwise. Only the boxes msg did not go
+    to are added.
+    """
+    maximumMessageSizeWarning = False
+    transient = True
+    with p.metrics.timer("wait"):
+        concurrent.futures.wait([future])
+    try:
+        appended = future.result()
+        p.endOk(msg)
+        if journal is not None:
+            journal.record(msg, "ok", appended)
+        return
+    except AlreadyUploaded:
+        p.endSkipped(msg, "already on the server")
+        if journal is not None:
+            journal.record(msg, "ok")
+        return
+    except socket.error as e:
+        error = "Socket error: " + str(e)
+    except Exception as e:
+        tooLarge = isinstance(e, MessageTooLarge) or re.search(r'maximum message size exceeded', repr(e))
+        maximumMessageSizeWarning = maximum_size_exceeded_are_warnings and tooLarge
+        transient = transient_failure(e) and not tooLarge
+        error = traceback.format_exc() if debug else e
+    msg_boxes, flags = msg.destination or ([None], None)
+    destination = (getattr(future.exception(), "missing_boxes", msg_boxes), flags)
+    if maximumMessageSizeWarning:
+        p.endWarning(msg, error)
+    elif deferred is not None and transient:
+        p.endDeferred(msg, error)
+        deferred.append((msg.offset, destination))
+    else:
+        p.endError(msg, error)
+        if failed is not None:
+            failed.append((msg.offset, destination))
+    if journal is not None:
+        journal.record(msg, "warning" if maximumMessageSizeWarning else "error")
+
+
+class AlreadyUploaded(Exception):
+    """The message is in each of its destination boxes already."""
+
+
+class MessageTooLarge(Exception):
+    """The message is larger than the server accepts, so it was not sent."""
+
+    def __init__(self, size, limit):
+        super().__init__("maximum message size exceeded: %.1f %sB, the server accepts up to %.1f %sB"
+                         % (si_prefix(size) + si_prefix(limit)))
+        self.size = size
+        self.limit = limit
+
+
+def message_key(msg):
+    """Return a hash identifying msg among the messages of a box.
+
+    The hash is that of the Message-ID field, or when there is none, of the
+    Date, From and Subject fields. Return None if msg has none of them.
+    """
+    message_id = " ".join((msg["message-id"] or "").split())
+    if message_id:
+        text = "id " + message_id
+    else:
+        text = "\0".join(" ".join((msg[name] or "").split()) for name in ("date", "from", "subject"))
+        if not text.strip("\0"):
+            return None
+    digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def fetch_message_keys(uploader, box, msg_box):
+    """Return the set of the message_key() of the messages in msg_box."""
+    headers = uploader.fetch_header_fields(box, ExistingMessages.fields, msg_box, 3)
+    keys = set(message_key(RawMessage(b"", header)) for header in headers)
+    keys.discard(None)
+    return keys
+
+
+class ExistingMessages:
+    """Tell which messages are in the destination boxes already.
+
+    The header fields identifying the messages of a box are fetched once,
+    the first time the box is looked up, and only the message_key() of each
+    message is kept. Fetching goes through imap.submit() like uploading, so
+    that it does not interleave with the commands in flight.
+    """
+
+    fields = ("MESSAGE-ID", "DATE", "FROM", "SUBJECT")
+
+    def __init__(self, imap, box):
+        self.imap = imap
+        self.box = box
+        self.keys = {}
+
+    def has(self, msg_box, msg):
+        """Tell whether msg is in msg_box, a Google Takeout box path or None."""
+        path = None if msg_box is None else tuple(msg_box)
+        if path not in self.keys:
+            key = self.box if msg_box is None else "/".join(msg_box)
+            print("Fetching the messages in {}...".format(key))
+            future = self.imap.submit(key, functools.partial(fetch_message_keys, box=self.box, msg_box=msg_box))
+            self.keys[path] = future.result()
+        key = message_key(msg)
+        return key is not None and key in self.keys[path]
+
+
+def count_messages(path, progress, done):
+    """Count the messages of the mbox at path and report it to progress.
+
+    Runs in a background thread over its own mapping of the file, and gives
+    up as soon as done is set.
+    """
+    src = MboxReader(path)
+    try:
+        count = src.count(done)
+    finally:
+        src.close()
+    if count is not None:
+        progress.set_total_count(count)
+
+
+def find_mailboxes(src, box, email_only_folders, separator, debug=False):
+    """Return the mbox files in the tree of folders src, as (path, box, size).
+
+    The tree is walked once, with os.scandir(). Each sub-folder becomes a
+    sub-box of box, named after it.
+    """
+    found = []
+    folders = [(str(src), box)]
+    while folders:
+        folder, box = folders.pop()
+        if debug: print("Visiting directory %s" % (folder))
+        with os.scandir(folder) as it:
+            entries = list(it)
+        # Servers that cannot store both messages and folders in a box
+        # get the messages of such a folder in a box of their own.
+        mixed_content = (any(entry.is_dir() for entry in entries) and
+                         any(mbox_name(entry.name).endswith("mbox") and not entry.is_dir() for entry in entries))
+        for entry in entries:
+            if entry.is_dir():
+                fileName, fileExtension = os.path.splitext(entry.name)
+                folders.append((entry.path, fileName if not box else box + separator + fileName))
+                continue
+            if mbox_name(entry.name).endswith("mbox"):
+                print("Found mailbox at {}...".format(entry.path))
+                path = entry.path
+            elif entry.name.endswith(".msf"):
+                path = entry.path.replace(".msf", "")
+                if not os.path.isfile(path):
+                    print("Skipping Thunderbird index without its mailbox: %s" % (entry.name))
+                    continue
+                print("Found Thunderbird mailbox at {}...".format(entry.path))
+            else:
+                print("Skipping unknown file (no mbox ending): %s" % (entry.name))
+                continue
+            if (email_only_folders and mixed_content):
+                target_box = box + separator + folder.split(os.sep)[-1]
+            else:
+                target_box = entry.name.split('.')[0] if (box is None or box == "") else box
+            found.append((path, target_box, os.path.getsize(path)))
+    return found
+
+
+def recursive_upload(imap, box, src, err, time_fields, email_only_folders, separator, debug=False, resume=False,
+                     skip_existing=False, metrics=None, quiet=False, mailboxes=1, stream_size=None,
+                     google_takeout=False, google_takeout_first_label=False, google_takeout_label_priority=None,
+                     google_takeout_box_as_base_folder=False, google_takeout_language="en",
+                     maximum_size_exceeded_are_warnings=False, batch_size=1, batch_bytes=1024 * 1024,
+                     parse_workers=0):
+    """Upload the mbox files in the tree of folders src, mailboxes of them at once.
+
+    The largest ones are started first, so that the small ones fill in
+    around them instead of a large one running alone at the end. The other
+    arguments are passed on to upload() for each of them. The rates and ETA
+    of the lines printed are those of the whole tree.
+    """
+    jobs = sorted(find_mailboxes(src, box, email_only_folders, separator, debug), key=lambda job: -job[2])
+    tree = Progress(sum(job[2] for job in jobs), metrics=metrics)
+    tree.resume(0, 0)
+    size, prefix = si_prefix(float(tree.total_bytes), threshold=0.8)
+    print("Found {} mail boxes, {:.1f} {}B in all.".format(len(jobs), size, prefix))
+    time_started = time.time()
+    imap.plan_folders(job[1] for job in jobs)
+    retry_backoff = RetryBackoff()
+
+    def upload_mailbox(job):
+        path, target_box, size = job
+        mbox = open_mbox(path, stream_size)
+        try:
+            return upload(imap, target_box, mbox, err, time_fields, google_takeout, google_takeout_first_label,
+                          google_takeout_label_priority, google_takeout_box_as_base_folder, google_takeout_language,
+                          debug, maximum_size_exceeded_are_warnings, batch_size, batch_bytes, resume, skip_existing,
+                          metrics, quiet, name=target_box if mailboxes > 1 else None, parse_workers=parse_workers,
+                          retry_backoff=retry_backoff, tree=tree)
+        finally:
+            mbox.close()
+
+    if mailboxes > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(mailboxes)
+        futures = [executor.submit(upload_mailbox, job) for job in jobs]
+        try:
+            progresses = [future.result() for future in futures]
+        finally:
+            # The mboxes not started yet are left alone if one failed.
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+    else:
+        progresses = [upload_mailbox(job) for job in jobs]
+    if len(progresses) > 1:
+        print("Done with %d mail boxes. (OK: %d, WARNING: %d, ERROR: %d, SKIPPED: %d) in %s" % \
+              (len(progresses), sum(p.ok_count for p in progresses), sum(p.warning_count for p in progresses),
+               sum(p.error_count for p in progresses), sum(p.skipped_count for p in progresses),
+               format_duration(time.time() - time_started)))
+
+list_response_re = re.compile(br'\([^)]*\) (?:"(?:[^"\\]|\\.)*"|NIL) (.*)$')
+
+def listed_names(data):
+    """Return the set of mail box names, in modified UTF-7, of LIST responses."""
+    names = set()
+    for item in data:
+        if isinstance(item, tuple):
+            # The name was sent as a literal.
+            names.add(item[1])
+            continue
+        m = list_response_re.match(item or b"")
+        if m is None:
+            continue
+        name = m.group(1)
+        if name[:1] == b'"':
+            name = re.sub(br'\\(.)', br'\1', name[1:-1])
+        names.add(name)
+    return names
 
 def pretty_print_mailboxes(boxes):
     for box in boxes:
@@ -578,17 +1610,78 @@ def pretty_flags(raw_flags):
     flags = flags.split()
     return "\t".join(flags)
 
-def get_delivery_time(self, fields):
-    """Extract delivery time from message.
+months = {name: i + 1 for i, name in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))}
+weekdays = r"(?:sun|mon|tue|wed|thu|fri|sat)"
+# The date of a From_ line, as written by asctime().
+from_time_re = re.compile(r"(?:" + weekdays + r"\s+)?([a-z]{3})\s+(\d{1,2})\s+(\d{1,2}):(\d\d)(?::(\d\d))?"
+                          r"\s+([1-9]\d{3})$", re.IGNORECASE)
+# The date of the Date: and Received: fields in the usual RFC 2822 form.
+date_time_re = re.compile(r"(?:" + weekdays + r"(?:,\s*|\s+))?(\d{1,2})\s+([a-z]{3})\s+([1-9]\d{3})"
+                          r"\s+(\d{1,2}):(\d\d)(?::(\d\d))?\s+([+-]\d{4}|GMT|UTC|UT)(?:\s*\([^()]*\))?$",
+                          re.IGNORECASE)
+
+epoch = datetime.date(1970, 1, 1).toordinal()
+
+def utc_time(year, month, day, hour, minute, second):
+    """Return the time of a UTC date given as strings (but month), like calendar.timegm()."""
+    days = datetime.date(int(year), month, int(day)).toordinal() - epoch
+    return ((days * 24 + int(hour)) * 60 + int(minute)) * 60 + int(second or 0)
+
+@functools.lru_cache(maxsize=4096)
+def parse_from_time(s):
+    """Return the time of the date of a From_ line, or None if it is not in asctime() form.
+
+    Like email.utils does, the date is taken as UTC.
+    """
+    m = from_time_re.match(s)
+    if not m:
+        return None
+    month, day, hour, minute, second, year = m.groups()
+    month = months.get(month.lower())
+    try:
+        return utc_time(year, month, day, hour, minute, second) if month else None
+    except ValueError:
+        # No such day, as in "Feb 30": left to email.utils.
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def parse_date_time(s):
+    """Return the time of an RFC 2822 date, or None if it is not in the usual form."""
+    m = date_time_re.match(s)
+    if not m:
+        return None
+    day, month, year, hour, minute, second, zone = m.groups()
+    month = months.get(month.lower())
+    if not month:
+        return None
+    offset = 0
+    if zone[0] in "+-":
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        if zone[0] == "-":
+            offset = -offset
+    try:
+        return utc_time(year, month, day, hour, minute, second) - offset
+    except ValueError:
+        return None
 
-    Try to extract the time data from given fields of message.
-    The fields is a list and can consist of any of the following:
-      * "from"      From_ line of mbox format.
-      * "received"  The first "Received:" field in RFC 2822.
-      * "date"      "Date:" field in RFC 2822.
-    Return the current time if the fields is empty or no field
-    had valid value.
+def fast_time_field(msg, field):
+    """Return the time in field of msg for the usual forms of dates, or None.
+
+    Gives the same time as email.utils would, only faster; None does not
+    mean that email.utils cannot parse it.
     """
+    if field == "from":
+        parts = msg.get_from().split(" ", 1)
+        return parse_from_time(parts[1].strip()) if len(parts) == 2 else None
+    if field == "received":
+        value = msg["received"]
+        return parse_date_time(value.split(";", 1)[1].strip()) if value and ";" in value else None
+    value = msg["date"]
+    return parse_date_time(value.strip()) if value else None
+
+def parse_time_field(msg, field):
+    """Return the time in field of msg as parsed by email.utils, or None."""
     def get_from_time(self):
         """Extract the time from From_ line."""
         time_str = self.get_from().split(" ", 1)[1]
@@ -608,32 +1701,1214 @@ def get_delivery_time(self, fields):
         """Extract the time from "Date:" field."""
         return self["date"]
 
+    try:
+        t = vars()["get_" + field + "_time"](msg)
+        t = email.utils.parsedate_tz(t)
+        return email.utils.mktime_tz(t)
+    except:
+        return None
+
+def get_delivery_time(self, fields):
+    """Extract delivery time from message.
+
+    Try to extract the time data from given fields of message.
+    The fields is a list and can consist of any of the following:
+      * "from"      From_ line of mbox format.
+      * "received"  The first "Received:" field in RFC 2822.
+      * "date"      "Date:" field in RFC 2822.
+    Return the current time if the fields is empty or no field
+    had valid value.
+    """
     for field in fields:
-        try:
-            t = vars()["get_" + field + "_time"](self)
-            t = email.utils.parsedate_tz(t)
-            t = email.utils.mktime_tz(t)
-            # Do not allow the time before 1970-01-01 because
-            # some IMAP server (i.e. Gmail) ignore it, and
-            # some MUA (Outlook Express?) set From_ date to
-            # 1965-01-01 for all messages.
-            if t < 0:
-                continue
+        t = fast_time_field(self, field)
+        if t is None:
+            t = parse_time_field(self, field)
+        # Do not allow the time before 1970-01-01 because
+        # some IMAP server (i.e. Gmail) ignore it, and
+        # some MUA (Outlook Express?) set From_ date to
+        # 1965-01-01 for all messages.
+        if t is not None and t >= 0:
             return t
-        except:
-            pass
     # All failed. Return current time.
     return time.time()
 
-# Directly attach get_delivery_time() to the mailbox.mboxMessage
-# as a method.
-# I want to use the factory parameter of mailbox.mbox()
-# but it seems not to work in Python 2.5.4.
-mailbox.mboxMessage.get_delivery_time = get_delivery_time
+
+class RawMessage:
+    """A message of a mbox file kept as raw bytes.
+
+    Only the header fields that are actually asked for are parsed, the
+    body is never touched so that it goes to the server unchanged.
+    """
+
+    header_end_re = re.compile(br"\r?\n\r?\n")
+    header_res = {}
+    # (description, flags, boxes, delivery time) when parsed by
+    # prepare_messages() in another process.
+    prepared = None
+    # (msg_boxes, flags) it is uploaded with, once known.
+    destination = None
+
+    def __init__(self, from_line, data, offset=0, span=None):
+        self.from_line = from_line
+        self.data = data
+        self.offset = offset
+        self.span = span
+        self.header_block = None
+        self.header_values = {}
+
+    def source_span(self):
+        """Return where the message starts and stops in the mbox file.
+
+        That is where it was read from in the file itself, for the progress:
+        in a compressed mbox, the offset is in the decompressed data.
+        """
+        if self.span is not None:
+            return self.span
+        return self.offset, self.offset + len(self.from_line) + 1 + len(self.data)
+
+    def get_from(self):
+        """Return the From_ line without the leading "From "."""
+        return self.from_line[5:].decode("ascii", "replace")
+
+    def get_header_block(self):
+        if self.header_block is None:
+            if isinstance(self.data, MappedRegion):
+                self.header_block = self.data.header_block(self.header_end_re)
+            else:
+                m = self.header_end_re.search(self.data)
+                self.header_block = self.data if m is None else self.data[:m.start() + 1]
+        return self.header_block
+
+    def __getitem__(self, name):
+        """Return the value of the first field called name, or None."""
+        name = name.lower()
+        if name not in self.header_values:
+            header_re = self.header_res.get(name)
+            if header_re is None:
+                header_re = re.compile(
+                    br"^" + re.escape(name.encode("ascii")) + br"[ \t]*:[ \t]*(.*(?:\r?\n[ \t].*)*)",
+                    re.IGNORECASE | re.MULTILINE)
+                self.header_res[name] = header_re
+            m = header_re.search(self.get_header_block())
+            value = None
+            if m is not None:
+                value = m.group(1).rstrip(b"\r\n").decode("utf-8", "replace")
+            self.header_values[name] = value
+        return self.header_values[name]
+
+    def get(self, name, default=None):
+        value = self[name]
+        return default if value is None else value
+
+    def mbox_pieces(self):
+        """Yield the message with its From_ line, as mailbox.mbox stores it, a piece at a time."""
+        yield self.from_line + b"\n"
+        yield from from_escaped(data_pieces(self.data))
+
+# Directly attach get_delivery_time() to RawMessage as a method.
+RawMessage.get_delivery_time = get_delivery_time
+
+
+def release_pages(map, start, stop):
+    """Let the system take back the pages of map from start to stop.
+
+    They are read from the file again if used later on: maps of mbox files
+    are read-only. Only the pages entirely in the range are released.
+    """
+    if hasattr(mmap, "MADV_DONTNEED") and isinstance(map, mmap.mmap):
+        start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+        stop = stop // mmap.PAGESIZE * mmap.PAGESIZE
+        if stop > start:
+            map.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+class MappedRegion:
+    """The data of a message too large to be copied out of the map of its mbox.
+
+    It is read a piece at a time, to be hashed or sent, and the pages of
+    each piece are released once it is: only the piece at hand takes up
+    memory.
+    """
+
+    piece_size = 1024 * 1024
+
+    def __init__(self, map, start, stop):
+        self.map = map
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def header_block(self, header_end_re):
+        """Return the bytes up to the first match of header_end_re, or all of them."""
+        m = header_end_re.search(self.map, self.start, self.stop)
+        return self.map[self.start:self.stop if m is None else m.start() + 1]
+
+    def pieces(self):
+        """Yield the bytes of the region in pieces of about piece_size, never splitting a CRLF."""
+        start = self.start
+        while start < self.stop:
+            stop = min(start + self.piece_size, self.stop)
+            if stop < self.stop and self.map[stop - 1] == ord("\r"):
+                stop += 1
+            piece = self.map[start:stop]
+            release_pages(self.map, start, stop)
+            yield piece
+            start = stop
+
+    def __bytes__(self):
+        return b"".join(self.pieces())
+
+
+class MboxReader:
+    """Stream the messages of a UNIX mbox file.
+
+    The file is memory mapped and split on From_ lines the same way as
+    mailbox.mbox does, but messages are yielded as RawMessage objects
+    instead of being parsed into email.message.Message trees.
+    """
+
+    # Reading from any offset costs nothing more than reading on.
+    random_access = True
+    # Messages larger than that are not copied out of the map, but read a
+    # piece at a time when needed: see MappedRegion.
+    stream_size = 4 * 1024 * 1024
+    # Bytes searched or read on between releases of the pages of the map.
+    scan_size = 16 * 1024 * 1024
+
+    def __init__(self, path, stream_size=None):
+        if not os.path.exists(path):
+            raise mailbox.NoSuchMailboxError(path)
+        self.path = path
+        if stream_size is not None:
+            self.stream_size = stream_size
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b""
+
+    def first_boundary(self, start=0):
+        """Return the offset of the first From_ line at or after start."""
+        if start == 0 and self.map[:5] == b"From ":
+            return 0
+        pos = self.find_boundary(max(start - 1, 0))
+        return -1 if pos == -1 else pos + 1
+
+    def find_boundary(self, pos):
+        """Return the offset of the first \\nFrom  at or after pos, or -1.
+
+        The map is searched scan_size bytes at a time, releasing the pages
+        searched through, so that a huge message is never all in memory.
+        """
+        while True:
+            end = pos + self.scan_size
+            found = self.map.find(b"\nFrom ", pos, end + 5)
+            if found != -1 or end + 5 >= self.size:
+                return found
+            release_pages(self.map, pos, end)
+            pos = end
+
+    def count(self, cancelled=None):
+        """Return the number of messages, or None if cancelled was set."""
+        count = 0
+        pos = released = self.first_boundary()
+        while pos != -1:
+            count += 1
+            if cancelled is not None and cancelled.is_set():
+                return None
+            if pos - released >= self.scan_size:
+                release_pages(self.map, released, pos)
+                released = pos
+            pos = self.find_boundary(pos)
+            if pos != -1:
+                pos += 1
+        return count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.messages()
+
+    def messages(self, start=0):
+        """Yield the messages found from the offset start on."""
+        mm = self.map
+        start = released = self.first_boundary(start)
+        while start != -1:
+            # The pages of the messages gone through are not needed any more.
+            if start - released >= self.scan_size:
+                release_pages(mm, released, start)
+                released = start
+            eol = mm.find(b"\n", start)
+            if eol == -1:
+                yield RawMessage(mm[start:].rstrip(b"\r"), b"", start)
+                return
+            following = self.find_boundary(eol)
+            stop = self.size if following == -1 else following + 1
+            # The blank line separating messages is not part of the message.
+            # It is left out before slicing: the slice is the only copy made.
+            if stop - eol >= 2 and mm[stop - 2:stop] == b"\n\n":
+                stop -= 1
+            if stop - eol - 1 > self.stream_size:
+                data = MappedRegion(mm, eol + 1, stop)
+            else:
+                data = mm[eol + 1:stop]
+            yield RawMessage(mm[start:eol].rstrip(b"\r"), data, start)
+            start = -1 if following == -1 else following + 1
+
+    def messages_at(self, offsets):
+        """Yield the messages at offsets, a sorted list of offsets of messages."""
+        for offset in offsets:
+            yield next(self.messages(offset))
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+
+def zstd_file(f):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading .zst mbox files needs the zstandard module: pip install zstandard")
+    return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+
+
+# Decompressing readers of a binary file object, by suffix of the mbox file.
+decompressors = {
+    ".gz": lambda f: gzip.GzipFile(fileobj=f, mode="rb"),
+    ".bz2": bz2.BZ2File,
+    ".xz": lzma.LZMAFile,
+    ".zst": zstd_file,
+}
+
+
+def mbox_name(name):
+    """Return the file name name without its compression suffix, if any."""
+    root, suffix = os.path.splitext(name)
+    return root if suffix.lower() in decompressors else name
+
+
+def open_mbox(path, stream_size=None):
+    """Return a reader of the mbox at path, compressed or not according to its suffix.
+
+    The messages larger than stream_size bytes are not read into memory.
+    """
+    if os.path.splitext(path)[1].lower() in decompressors:
+        return CompressedMboxReader(path, stream_size)
+    return MboxReader(path, stream_size)
+
+
+class CompressedMboxReader:
+    """Stream the messages of a compressed mbox file: .gz, .bz2, .xz or .zst.
+
+    The messages are split as by MboxReader, from the data decompressed a
+    chunk at a time: only the message at hand and the next chunk are kept
+    in memory, and nothing is written to disk but the messages larger than
+    stream_size: each of them goes to a temporary file as it is
+    decompressed, and is read from its map as from the map of a mbox. The
+    offsets of the messages are in the decompressed mbox, their span in
+    the compressed file. Going back to an offset decompresses the file from
+    its start again, so messages are best read in one pass.
+    """
+
+    random_access = False
+    stream_size = MboxReader.stream_size
+    # Decompressed at once: the smaller, the closer the progress follows.
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, stream_size=None):
+        if not os.path.exists(path):
+            raise mailbox.NoSuchMailboxError(path)
+        self.path = path
+        if stream_size is not None:
+            self.stream_size = stream_size
+        self.decompressor = decompressors[os.path.splitext(path)[1].lower()]
+        self.size = os.path.getsize(path)
+        # Fail now rather than at the first message if it cannot be read.
+        f, reader = self.open()
+        try:
+            self.read(reader, 1)
+        finally:
+            self.close_file(f, reader)
+
+    def open(self):
+        """Return the compressed file and a decompressing reader of it."""
+        f = open(self.path, "rb")
+        try:
+            return f, self.decompressor(f)
+        except BaseException:
+            f.close()
+            raise
+
+    def read(self, reader, size):
+        """Return up to size bytes more of the decompressed mbox, b"" at its end."""
+        try:
+            return reader.read(size)
+        except (OSError, EOFError, lzma.LZMAError) as e:
+            raise mailbox.FormatError("%s: %s" % (self.path, e))
+
+    @staticmethod
+    def close_file(f, reader):
+        reader.close()
+        f.close()
+
+    def count(self, cancelled=None):
+        """Return the number of messages, or None if cancelled was set."""
+        f, reader = self.open()
+        try:
+            count = 0
+            # A From_ line at the very start counts too. The tail of each
+            # chunk is kept for the lines starting there, but too short to
+            # hold a whole \nFrom  counted already.
+            tail = b"\n"
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                chunk = self.read(reader, self.chunk_size)
+                if not chunk:
+                    return count
+                chunk = tail + chunk
+                count += chunk.count(b"\nFrom ")
+                tail = chunk[-5:]
+        finally:
+            self.close_file(f, reader)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return self.messages()
+
+    def messages(self, start=0):
+        """Yield the messages found from the offset start on."""
+        f, reader = self.open()
+        # The decompressed data from offset base on.
+        buf = bytearray()
+        base = 0
+        eof = False
+        # The temporary file the message at hand goes to, once found too large.
+        spool = None
+
+        def read():
+            nonlocal eof
+            chunk = self.read(reader, self.chunk_size)
+            buf.extend(chunk)
+            eof = not chunk
+
+        def find(sub, pos, keep, spill=False):
+            """Return the offset of sub at or after pos, reading on as needed.
+
+            The data before keep, or before pos if keep is None, is dropped.
+            With spill, once there are more than stream_size bytes from keep
+            on, those before pos go to spool instead of being kept.
+            """
+            nonlocal base, spool
+            while True:
+                found = buf.find(sub, pos - base) if pos - base <= len(buf) else -1
+                if found != -1:
+                    return base + found
+                if eof:
+                    return -1
+                pos = max(pos, base + len(buf) - len(sub) + 1)
+                drop = min((pos if keep is None else keep) - base, len(buf))
+                if drop > 0:
+                    del buf[:drop]
+                    base += drop
+                if spill and (spool is not None or base + len(buf) - keep > self.stream_size):
+                    if spool is None:
+                        spool = tempfile.TemporaryFile()
+                    with memoryview(buf) as view:
+                        spool.write(view[:pos - base])
+                    del buf[:pos - base]
+                    base = pos
+                read()
+
+        def boundary(pos, keep, spill=False):
+            """Return the offset of the first From_ line at or after pos, or -1."""
+            if pos == 0:
+                while len(buf) < 5 and not eof:
+                    read()
+                if buf[:5] == b"From ":
+                    return 0
+            found = find(b"\nFrom ", max(pos - 1, 0), keep, spill)
+            return -1 if found == -1 else found + 1
+
+        def take(start, stop):
+            with memoryview(buf) as view:
+                return bytes(view[start - base:stop - base])
+
+        try:
+            position = f.tell()
+            start = boundary(start, None)
+            while start != -1:
+                eol = find(b"\n", start, start)
+                if eol == -1:
+                    yield RawMessage(take(start, base + len(buf)).rstrip(b"\r"), b"", start, (position, f.tell()))
+                    return
+                from_line = take(start, eol).rstrip(b"\r")
+                following = boundary(eol + 1, start, spill=True)
+                stop = base + len(buf) if following == -1 else following
+                if spool is not None:
+                    data = self.spooled(spool, eol + 1 - start, take(base, stop))
+                    spool = None
+                else:
+                    # The blank line separating messages is not part of the message.
+                    if stop - eol >= 2 and buf[stop - 2 - base:stop - base] == b"\n\n":
+                        stop -= 1
+                    data = take(eol + 1, stop)
+                msg = RawMessage(from_line, data, start, (position, f.tell()))
+                position = msg.span[1]
+                yield msg
+                start = following
+        finally:
+            if spool is not None:
+                spool.close()
+            self.close_file(f, reader)
+
+    @staticmethod
+    def spooled(spool, start, rest):
+        """Return the MappedRegion of a message from start on in spool, once rest is added."""
+        spool.write(rest)
+        spool.flush()
+        # The map keeps the file, which has no name, until it is closed.
+        map = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        spool.close()
+        stop = len(map)
+        if stop - start >= 1 and map[stop - 2:stop] == b"\n\n":
+            stop -= 1
+        return MappedRegion(map, start, stop)
+
+    def messages_at(self, offsets):
+        """Yield the messages at offsets, a sorted list of offsets of messages, in one pass."""
+        offsets = iter(offsets)
+        offset = next(offsets, None)
+        if offset is None:
+            return
+        for msg in self.messages(offset):
+            if msg.offset == offset:
+                yield msg
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+
+    def close(self):
+        pass
+
+
+class ErrorMbox:
+    """The mbox of --error, shared by the mboxes uploaded at once.
+
+    Next to it, path.targets has a line of JSON for each message added: the
+    hash of the message, and the box, destination boxes and flags it was
+    uploaded with, for --replay-errors to send it there again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        open(path, "ab").close()
+        self.lock = threading.Lock()
+
+    def add(self, box, messages):
+        """Append messages, (msg, (msg_boxes, flags)) pairs, in one go.
+
+        They are written the way mailbox.mbox.add() does, but a piece at a
+        time, so that large messages are not read into memory whole.
+        """
+        with self.lock:
+            with open(self.path, "ab") as mbox, open(self.path + ".targets", "a", encoding="utf-8") as targets:
+                for msg, (msg_boxes, flags) in messages:
+                    for piece in msg.mbox_pieces():
+                        mbox.write(piece)
+                    # The blank line ending each message.
+                    mbox.write(b"\n")
+                    targets.write(json.dumps({"hash": UploadJournal.hash(msg).hex(), "box": box,
+                                              "boxes": msg_boxes, "flags": flags}) + "\n")
+                mbox.flush()
+                os.fsync(mbox.fileno())
+
+    @staticmethod
+    def targets(path):
+        """Return what path.targets tells of the messages of the mbox path, by hash."""
+        targets = {}
+        try:
+            with open(path + ".targets", encoding="utf-8") as f:
+                for line in f:
+                    target = json.loads(line)
+                    targets[bytes.fromhex(target.pop("hash"))] = target
+        except FileNotFoundError:
+            pass
+        return targets
+
+
+class UploadJournal:
+    """Record the outcome of each message of a mbox, to resume an upload.
+
+    The journal is a SQLite database keyed by the path of the mbox and the
+    offset of the message, together with a hash of its content and the
+    APPENDUID of the server when known. The position after the last message
+    reported is kept as a checkpoint, so that a resumed upload seeks there
+    at once instead of going through the messages already done.
+    """
+
+    # Seconds between commits; an interrupted upload loses at most that.
+    commit_interval = 1.0
+
+    def __init__(self, path, mbox_path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (mbox TEXT, offset INTEGER, hash BLOB, "
+                        "status TEXT, uid TEXT, PRIMARY KEY (mbox, offset))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (mbox TEXT PRIMARY KEY, position INTEGER)")
+        self.mbox = os.path.realpath(mbox_path)
+        self.position = None
+        self.committed = time.time()
+        # Set when the mbox changed since the checkpoint was written: each
+        # message is then looked up on its own.
+        self.check_each = False
+
+    @staticmethod
+    def hash(msg):
+        h = hashlib.blake2b(digest_size=16)
+        for piece in data_pieces(msg.data):
+            h.update(piece)
+        return h.digest()
+
+    def resume_position(self, src):
+        """Return the offset to resume src from and the count of messages before it."""
+        row = self.db.execute("SELECT position FROM checkpoints WHERE mbox = ?", (self.mbox,)).fetchone()
+        if row is None:
+            return 0, 0
+        position = row[0]
+        last = self.db.execute("SELECT offset, hash FROM messages WHERE mbox = ? AND offset < ? "
+                               "ORDER BY offset DESC LIMIT 1", (self.mbox, position)).fetchone()
+        if last is not None:
+            msg = next(src.messages(last[0]), None)
+            if msg is None or msg.offset != last[0] or self.hash(msg) != last[1]:
+                print("The mbox changed since the last upload, checking each message against the journal.")
+                self.check_each = True
+                return 0, 0
+        count = self.db.execute("SELECT COUNT(*) FROM messages WHERE mbox = ? AND offset < ?",
+                                (self.mbox, position)).fetchone()[0]
+        return position, count
+
+    def uploaded(self, msg):
+        """Return whether the journal has msg as successfully uploaded."""
+        row = self.db.execute("SELECT hash, status FROM messages WHERE mbox = ? AND offset = ?",
+                              (self.mbox, msg.offset)).fetchone()
+        return row is not None and row[1] == "ok" and row[0] == self.hash(msg)
+
+    def record(self, msg, status, appended=None):
+        """Record the status of msg: "ok", "warning" or "error".
+
+        appended is the (UIDVALIDITY, UID) pair of the message on the
+        server, when known.
+        """
+        uid = None
+        if appended:
+            uid = b"%s:%s" % appended
+            uid = uid.decode("ascii")
+        self.db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                        (self.mbox, msg.offset, self.hash(msg), status, uid))
+        # The messages tried again come after the others.
+        self.position = max(self.position or 0, msg.offset + len(msg.from_line) + 1 + len(msg.data))
+        if time.time() - self.committed >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        if self.position is not None:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)", (self.mbox, self.position))
+        self.db.commit()
+        self.committed = time.time()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def crlf_lines(message):
+    """Return message with CRLF line endings, as IMAP literals have.
+
+    A message that has them already is returned as is, without a copy. One
+    in a MappedRegion becomes a StreamedLiteral.
+    """
+    if isinstance(message, MappedRegion):
+        return StreamedLiteral(message)
+    if isinstance(message, StreamedLiteral):
+        return message
+    if message.count(b"\n") == message.count(b"\r") == message.count(b"\r\n"):
+        return message
+    # The same as imaplib.MapCRLF.sub(), without a piece per line: a
+    # replace() that finds nothing returns message itself, so a mbox with
+    # LF line endings is copied once.
+    return message.replace(b"\r\n", b"\n").replace(b"\r", b"\n").replace(b"\n", imaplib.CRLF)
+
+
+class StreamedLiteral:
+    """The literal of a message in a MappedRegion, with CRLF line endings.
+
+    Its pieces are converted as they are sent. Its length, which goes
+    before it, is counted beforehand by going through the region once.
+    """
+
+    def __init__(self, region):
+        self.region = region
+        size = len(region)
+        for piece in region.pieces():
+            # Each line ending, CRLF, CR or LF alone, becomes a CRLF.
+            size += piece.count(b"\r") + piece.count(b"\n") - 2 * piece.count(b"\r\n")
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def pieces(self):
+        for piece in self.region.pieces():
+            yield crlf_lines(piece)
+
+
+def data_pieces(data):
+    """Return the pieces to read data in: itself, unless it is a MappedRegion or StreamedLiteral."""
+    return (data,) if isinstance(data, bytes) else data.pieces()
+
+
+def from_escaped(pieces):
+    """Yield the bytes of pieces with a ">" before "From " at the start of each line but the first.
+
+    That is what mailbox.mbox does to the messages it adds. The bytes after
+    the last line end of a piece are held back while too short to tell
+    whether they start a "From " line. A line end is added at the end if
+    there is none, even to no bytes at all.
+    """
+    held = last = b""
+    for piece in pieces:
+        data = held + piece
+        end = data.rfind(b"\n")
+        if end == -1 or len(data) - end > len(b"\nFrom"):
+            end = len(data)
+        held = data[end:]
+        data = data[:end].replace(b"\nFrom ", b"\n>From ")
+        if data:
+            last = data[-1:]
+            yield data
+    if held:
+        last = held[-1:]
+        yield held
+    if last != b"\n":
+        yield b"\n"
+
+
+def append_arguments(flags, date_time, message):
+    """Return the flags, date_time and literal arguments of APPEND.
+
+    They are built the same way imaplib.IMAP4.append() does; flags and
+    date_time are None when not given.
+    """
+    if flags:
+        if (flags[0], flags[-1]) != ('(', ')'):
+            flags = '(%s)' % flags
+    else:
+        flags = None
+    if date_time:
+        date_time = imaplib.Time2Internaldate(date_time)
+    else:
+        date_time = None
+    return flags, date_time, crlf_lines(message)
+
+
+def non_synchronizing_limit(capabilities):
+    """Return the size up to which literals need not wait for the server.
+
+    With LITERAL+ (RFC 7888) any literal can be sent right after its
+    command line, with LITERAL- only the ones up to 4096 bytes. Otherwise
+    every literal must wait for the continuation of the server.
+    """
+    if "LITERAL+" in capabilities:
+        return float("inf")
+    if "LITERAL-" in capabilities:
+        return 4096
+    return -1
+
+
+# Largest messages accepted by the servers of --gmail, --office365 and
+# --fastmail, for when they do not advertise APPENDLIMIT.
+provider_append_limits = {
+    "imap.gmail.com": 35651584,
+    "outlook.office365.com": 36700160,
+    "imap.fastmail.com": 73400320,
+}
+
+def append_limit(capabilities, host):
+    """Return the size of the largest message the server accepts, or None.
+
+    That is the APPENDLIMIT=N it advertises (RFC 7889), or else the limit
+    known for host. A bare APPENDLIMIT means that the limit depends on the
+    mail box, which is left to the server to tell.
+    """
+    for capability in capabilities:
+        if capability.startswith("APPENDLIMIT="):
+            try:
+                return int(capability[len("APPENDLIMIT="):])
+            except ValueError:
+                break
+    return provider_append_limits.get(host.lower())
+
+
+class CompressionStats:
+    """Bytes and CPU time spent by COMPRESS=DEFLATE on connections."""
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_deflated = 0
+        self.received = 0
+        self.received_deflated = 0
+        self.cpu_time = 0.0
+
+    def add(self, other):
+        for name in ("sent", "sent_deflated", "received", "received_deflated", "cpu_time"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def __str__(self):
+        sent, sent_prefix = si_prefix(float(self.sent), threshold=0.8)
+        deflated, deflated_prefix = si_prefix(float(self.sent_deflated), threshold=0.8)
+        return "sent %.1f %sB as %.1f %sB (%.1fx), received %.1fx, %.1f sec CPU" % \
+            (sent, sent_prefix, deflated, deflated_prefix, self.sent / max(self.sent_deflated, 1),
+             self.received / max(self.received_deflated, 1), self.cpu_time)
+
+
+class DeflateCodec:
+    """Compress and inflate the data of a COMPRESS=DEFLATE connection (RFC 4978)."""
+
+    def __init__(self, stats):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.inflated = bytearray()
+        self.stats = stats
+
+    def compress(self, data):
+        started = time.thread_time()
+        deflated = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.stats.cpu_time += time.thread_time() - started
+        self.stats.sent += len(data)
+        self.stats.sent_deflated += len(deflated)
+        return deflated
+
+    def inflate(self, data):
+        started = time.thread_time()
+        inflated = self.decompressor.decompress(data)
+        self.stats.cpu_time += time.thread_time() - started
+        self.stats.received += len(inflated)
+        self.stats.received_deflated += len(data)
+        self.inflated += inflated
+
+    def take(self, size):
+        """Return the first size inflated bytes, or None if not there yet."""
+        if len(self.inflated) < size:
+            return None
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def take_line(self, limit=-1):
+        """Return the first inflated line, or None if not there yet."""
+        end = self.inflated.find(b"\n")
+        if end == -1:
+            if 0 < limit <= len(self.inflated):
+                return self.take(limit)
+            return None
+        return self.take(end + 1 if limit <= 0 else min(end + 1, limit))
+
+    def take_all(self):
+        return self.take(len(self.inflated))
+
+
+class DeflateFile:
+    """Inflate what imaplib reads from a compressed connection."""
+
+    def __init__(self, file, codec):
+        self.file = file
+        self.codec = codec
+
+    def fill(self):
+        data = self.file.read1(65536)
+        if data:
+            self.codec.inflate(data)
+        return bool(data)
+
+    def readline(self, limit=-1):
+        while True:
+            line = self.codec.take_line(limit)
+            if line is not None:
+                return line
+            if not self.fill():
+                return self.codec.take_all()
+
+    def read(self, size):
+        while True:
+            data = self.codec.take(size)
+            if data is not None:
+                return data
+            if not self.fill():
+                return self.codec.take_all()
+
+    def close(self):
+        self.file.close()
+
+
+class AsyncDeflateReader:
+    """Inflate what AsyncIMAP4 reads from a compressed connection."""
+
+    def __init__(self, reader, codec):
+        self.reader = reader
+        self.codec = codec
+
+    async def fill(self):
+        data = await self.reader.read(65536)
+        if data:
+            self.codec.inflate(data)
+        return bool(data)
+
+    async def readline(self):
+        while True:
+            line = self.codec.take_line()
+            if line is not None:
+                return line
+            if not await self.fill():
+                return self.codec.take_all()
+
+    async def readexactly(self, size):
+        while True:
+            data = self.codec.take(size)
+            if data is not None:
+                return data
+            if not await self.fill():
+                raise asyncio.IncompleteReadError(self.codec.take_all(), size)
+
+
+class IMAP4Extensions:
+    """Commands of IMAP extensions that imaplib does not provide."""
+
+    codec = None
+
+    def compress(self, stats):
+        """Compress the rest of the session with DEFLATE (RFC 4978)."""
+        typ, dat = self.literal_command("COMPRESS", ["DEFLATE"], [])
+        if typ == "OK":
+            self.codec = DeflateCodec(stats)
+            self.file = DeflateFile(self.file, self.codec)
+        return typ, dat
+
+    def send(self, data):
+        if self.codec is not None:
+            data = self.codec.compress(data)
+        super().send(data)
+
+    def login(self, user, password):
+        typ, dat = super().login(user, password)
+        # Servers may advertise more capabilities once logged in.
+        self._get_capabilities()
+        return typ, dat
+
+    def append(self, mailbox, flags, date_time, message):
+        flags, date_time, literal = append_arguments(flags, date_time, message)
+        return self.literal_command("APPEND", [mailbox, flags, date_time], [(literal, [])])
+
+    def multiappend(self, mailbox, messages):
+        """Append messages to mailbox with a single command (RFC 3502).
+
+        messages is a list of (flags, date_time, message) tuples, with the
+        same meaning as the arguments of append().
+        """
+        arguments = [append_arguments(*message) for message in messages]
+        literals = [(literal, next_arguments[:2]) for (flags, date_time, literal), next_arguments
+                    in zip(arguments, arguments[1:] + [(None, None, None)])]
+        flags, date_time, literal = arguments[0]
+        return self.literal_command("APPEND", [mailbox, flags, date_time], literals)
+
+    def examine(self, mailbox):
+        """Select mailbox read-only and return its UIDVALIDITY, or None."""
+        self.untagged_responses.pop("UIDVALIDITY", None)
+        typ, dat = self.select(mailbox, readonly=True)
+        if typ != "OK":
+            return None
+        typ, dat = self.response("UIDVALIDITY")
+        return dat[-1] if dat and dat[-1] else None
+
+    def search_uids(self):
+        """Return the UIDs of the messages of the selected mailbox."""
+        typ, dat = self.uid("SEARCH", "ALL")
+        if typ != "OK":
+            raise self.error(dat[-1])
+        return b" ".join(d for d in dat if d).split()
+
+    def fetch_header_fields(self, uids, fields):
+        """Return the header fields called fields of the messages of a UID set."""
+        typ, dat = self.uid("FETCH", uids, "(BODY.PEEK[HEADER.FIELDS (%s)])" % " ".join(fields))
+        if typ != "OK":
+            raise self.error(dat[-1])
+        return [d[1] for d in dat if isinstance(d, tuple)]
+
+    def encode_arguments(self, args):
+        return [arg if isinstance(arg, bytes) else bytes(arg, self._encoding) for arg in args if arg is not None]
+
+    def literal_command(self, name, args, literals):
+        """Send a command with literals and return its tagged response.
+
+        literals is a list of (literal, arguments) pairs: each literal goes
+        after the arguments before it, and is followed by its arguments.
+        Literals are sent without waiting for the server when it allows it.
+        """
+        # EXISTS and RECENT come with each APPEND to the selected mailbox
+        # and are never read: do not let them pile up.
+        for typ in ('OK', 'NO', 'BAD', 'EXISTS', 'RECENT'):
+            self.untagged_responses.pop(typ, None)
+        limit = non_synchronizing_limit(self.capabilities)
+        tag = self._new_tag()
+        line = b" ".join([tag, bytes(name, self._encoding)] + self.encode_arguments(args))
+        try:
+            for literal, more in literals:
+                if len(literal) <= limit:
+                    self.send(line + b" {%d+}" % len(literal) + imaplib.CRLF)
+                else:
+                    self.send(line + b" {%d}" % len(literal) + imaplib.CRLF)
+                    while self._get_response():
+                        if self.tagged_commands[tag]:
+                            return self._command_complete(name, tag)
+                for piece in data_pieces(literal):
+                    self.send(piece)
+                line = b"".join(b" " + arg for arg in self.encode_arguments(more))
+            self.send(line + imaplib.CRLF)
+        except OSError as val:
+            raise self.abort('socket error: %s' % val)
+        return self._command_complete(name, tag)
+
+
+class IMAP4(IMAP4Extensions, imaplib.IMAP4):
+    pass
+
+
+class IMAP4_SSL(IMAP4Extensions, imaplib.IMAP4_SSL):
+    pass
+
+
+class Backoff:
+    """Tell how long to wait before reconnecting, with jittered exponential backoff.
+
+    The n-th reconnection in a row for a command waits a random time between
+    half and all of initial * 2**n seconds, up to maximum. The waits of all
+    the connections sharing a Backoff are counted against budget seconds;
+    once it is spent, connection errors are raised instead of retried.
+    """
+
+    def __init__(self, initial=0.5, maximum=60.0, budget=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.budget = budget
+        self.slept = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self, attempt):
+        """Return the seconds to wait before reconnection attempt, None if the budget is spent."""
+        with self.lock:
+            if self.budget is not None and self.slept >= self.budget:
+                return None
+            delay = min(self.maximum, self.initial * 2 ** min(attempt, 32))
+            delay = random.uniform(delay / 2, delay)
+            if self.budget is not None:
+                delay = min(delay, self.budget - self.slept)
+            self.slept += delay
+            return delay
+
+
+class RetryBackoff(Backoff):
+    """The wait before the messages that failed are tried again.
+
+    It grows with each such second pass of the run, as with -r each mbox
+    makes its own, until one of them gets messages through.
+    """
+
+    def __init__(self, initial=5.0, maximum=120.0):
+        super().__init__(initial, maximum)
+        self.passes = itertools.count()
+
+    def next_delay(self):
+        return self.delay(next(self.passes))
+
+    def reset(self):
+        """Start over from the shortest wait: the server takes messages again."""
+        self.passes = itertools.count()
+
+
+# NO responses of servers asking to slow down: the response codes of RFC
+# 5530 for that, Gmail's THROTTLED and the wording of some others.
+throttled_re = re.compile(br"\[(?:THROTTLED|UNAVAILABLE|INUSE)\]|try again later|too many|rate limit|throttl",
+                          re.IGNORECASE)
+
+def throttling_response(data):
+    """Tell whether the data of a NO response asks to slow down."""
+    return any(isinstance(line, bytes) and throttled_re.search(line) for line in data or ())
+
+
+def transient_failure(e):
+    """Tell whether an upload that failed with e may work when tried again later.
+
+    It may if the connection was lost or the server asked to slow down, not
+    if the message could not be read or the server refused it for good.
+    """
+    if isinstance(e, (imaplib.IMAP4.abort, OSError, asyncio.TimeoutError)):
+        return True
+    return throttling_response(e.args)
+
+
+class RateController:
+    """Adapt the APPENDs in flight and the upload rate to the server.
+
+    Each APPEND waits in acquire() until fewer than limit are in flight,
+    then for its bytes to fit in rate, if there is one, and in the daily
+    budget. The limit starts at maximum, without a rate: as long as the
+    server does not complain, nothing is held back.
+
+    When it throttles (a NO asking to slow down, a BYE or a dropped
+    connection) or slows down (small messages taking slowdown times as
+    long as the fastest ones did), nothing is sent for pause seconds, the
+    limit is halved and the rate set to half the throughput of the last
+    second; the APPENDs started before that only echo the same congestion. Each APPEND that
+    goes well then adds 1/limit to the limit, one per round of APPENDs, and
+    the rate grows by a tenth of what it was set to each second. Without
+    adaptive, only the daily budget is enforced.
+    """
+
+    # The latency of the server is that of the messages up to this size.
+    small_size = 64 * 1024
+    minimum_rate = 64 * 1024
+
+    def __init__(self, maximum=1, daily_bytes=None, adaptive=True, metrics=None, slowdown=4.0, pause=1.0):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.daily_bytes = daily_bytes
+        self.adaptive = adaptive
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.slowdown = slowdown
+        self.pause = pause
+        self.changed = threading.Condition()
+        self.in_flight = 0
+        # Bytes per second, None for no limit, and when it last grew.
+        self.rate = None
+        self.rate_step = 0.0
+        self.rate_grown = 0.0
+        # When the next APPEND may start, under rate.
+        self.next_send = 0.0
+        self.decreased = float("-inf")
+        # Seconds taken by the fastest small APPEND, and on average lately.
+        self.fastest = None
+        self.latency = None
+        # Bytes appended since window_started, and per second in the last window.
+        self.window_started = time.monotonic()
+        self.window_bytes = 0
+        self.throughput = 0.0
+        self.day_started = time.time()
+        self.day_bytes = 0
+        self.day_reported = None
+
+    def acquire(self, size):
+        """Wait until an APPEND of size bytes may be sent; return the time it starts."""
+        with self.changed:
+            while self.in_flight >= int(self.limit):
+                self.changed.wait()
+            self.in_flight += 1
+            if self.daily_bytes is not None:
+                self.take_budget(size)
+            delay = 0.0
+            if self.rate is not None:
+                now = time.monotonic()
+                start = max(self.next_send, now)
+                self.next_send = start + size / self.rate
+                delay = start - now
+        if delay > 0:
+            with self.metrics.timer("throttle"):
+                time.sleep(delay)
+        return time.monotonic()
+
+    def take_budget(self, size):
+        # Called with the lock held; a message larger than the budget
+        # goes alone on a day of its own.
+        while True:
+            now = time.time()
+            if now - self.day_started >= 86400:
+                self.day_started += (now - self.day_started) // 86400 * 86400
+                self.day_bytes = 0
+            if self.day_bytes == 0 or self.day_bytes + size <= self.daily_bytes:
+                self.day_bytes += size
+                return
+            resume = self.day_started + 86400
+            if self.day_reported != self.day_started:
+                self.day_reported = self.day_started
+                budget, prefix = si_prefix(float(self.daily_bytes), threshold=0.8)
+                print("(Daily budget of %.1f %sB used up, waiting until %s)" %
+                      (budget, prefix, time.strftime("%Y-%m-%d %H:%M", time.localtime(resume))), flush=True)
+            with self.metrics.timer("budget"):
+                self.changed.wait(resume - now)
+
+    def release(self, size, started, throttled):
+        """Called when an APPEND of size bytes started at started is answered.
+
+        throttled tells whether the server asked to slow down instead.
+        """
+        now = time.monotonic()
+        seconds = now - started
+        with self.changed:
+            self.in_flight -= 1
+            if not throttled:
+                self.window_bytes += size
+            if now - self.window_started >= 1.0:
+                self.throughput = self.window_bytes / (now - self.window_started)
+                self.window_started = now
+                self.window_bytes = 0
+            if self.adaptive:
+                slow = False
+                if not throttled and size <= self.small_size:
+                    self.fastest = seconds if self.fastest is None else min(self.fastest, seconds)
+                    self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+                    slow = self.latency > self.slowdown * max(self.fastest, 0.05)
+                if not (throttled or slow):
+                    self.increase(now)
+                elif started >= self.decreased:
+                    self.decrease(now)
+            self.changed.notify_all()
+
+    def increase(self, now):
+        self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        if self.rate is not None:
+            self.rate += self.rate_step * (now - self.rate_grown)
+            self.rate_grown = now
+
+    def decrease(self, now):
+        self.decreased = now
+        self.limit = max(1.0, self.limit / 2)
+        throughput = self.throughput or self.window_bytes / max(now - self.window_started, 1.0)
+        self.rate = max(float(self.minimum_rate), throughput / 2)
+        self.rate_step = self.rate / 10
+        self.rate_grown = now
+        self.next_send = max(self.next_send, now + self.pause)
+        # Measure the latency again from here.
+        self.latency = self.fastest
+        self.metrics.count("throttled")
+        rate, prefix = si_prefix(self.rate, threshold=0.8)
+        print("(Server busy: %d in flight at %.1f %sB/s)" % (int(self.limit), rate, prefix), end=' ', flush=True)
 
 
 class IMAPUploader:
-    def __init__(self, host, port, ssl, box, user, password, retry, folder_separator, dry_run):
+    # Number of messages upload() lets in flight before waiting for the
+    # oldest one: submit() runs the work at once on this single connection.
+    window = 1
+    # Number of messages fetch_header_fields() asks for with one command.
+    fetch_chunk = 5000
+
+    def __init__(self, host, port, ssl, box, user, password, retry, folder_separator, dry_run, compress=False,
+                 metrics=None, backoff=None, controller=None):
         self.imap = None
         self.host = host
         self.port = port
@@ -642,36 +2917,157 @@ class IMAPUploader:
         self.password = password
         self.retry = retry
         self.box = box
-        self.created_directories_cache = []
+        # Mail box names known to exist on the server, as given to CREATE.
+        # Kept across reconnections: the folders created before are still there.
+        self.created_directories_cache = set()
         self.separator = folder_separator
         self.dry_run = dry_run
+        self.compress = compress
+        self.compression = CompressionStats()
+        # Size of the largest message the server accepts, once connected.
+        self.append_limit = None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.backoff = backoff if backoff is not None else Backoff()
+        # The RateController of the run, if any, shared by all connections.
+        self.controller = controller
+        # (connection, mailbox) last selected by copy().
+        self.selected = None
+        # upload() may be called from several threads at once when the
+        # connection pipelines its commands (see AsyncIMAPUploader).
+        self.lock = threading.RLock()
 
     def upload(self, box, delivery_time, message, flags = None, google_takeout_box_path = None, retry = None):
-        if retry is None:
-            retry = self.retry
         if flags is None:
             flags = []
+
+        def append(imap, mailbox):
+            typ, data = imap.append(mailbox, flags, delivery_time, message)
+            self.metrics.count("bytes_sent", len(message))
+            return typ, data
+        return self.send(box, google_takeout_box_path, append, retry, size=len(message))
+
+    def upload_batch(self, box, messages, google_takeout_box_path = None, retry = None):
+        """Upload messages, a list of (flags, delivery_time, message), with MULTIAPPEND."""
+        size = sum(len(message) for flags, delivery_time, message in messages)
+
+        def append(imap, mailbox):
+            typ, data = imap.multiappend(mailbox, messages)
+            self.metrics.count("bytes_sent", size)
+            return typ, data
+        return self.send(box, google_takeout_box_path, append, retry, size=size)
+
+    def send(self, box, google_takeout_box_path, append, retry = None, phase = "append", size = None):
+        """Run append(imap, mailbox) on the destination box, reconnecting on abort.
+
+        The time append() takes is accounted to phase in the metrics. Up to
+        retry reconnections are made, waiting as long as backoff tells.
+        When append() sends size bytes of messages, the controller lets it.
+        """
+        if retry is None:
+            retry = self.retry
+        attempt = 0
+        while True:
+            imap = None
+            try:
+                self.open()
+                imap = self.imap
+                mailbox = self.mailbox_name(box, google_takeout_box_path)
+                # Nothing to do for the boxes of plan_folders().
+                if mailbox not in self.created_directories_cache:
+                    with self.metrics.timer("folders"):
+                        if google_takeout_box_path is not None: # Google Takeout
+                            self.create_folder(google_takeout_box_path)
+                        else: # Default behaviour
+                            self.imap_create(mailbox)
+                with self.metrics.timer(phase):
+                    if size is None or self.controller is None:
+                        return append(imap, mailbox)
+                    started = self.controller.acquire(size)
+                    throttled = False
+                    try:
+                        typ, data = append(imap, mailbox)
+                        throttled = typ != "OK" and throttling_response(data)
+                        return typ, data
+                    except (imaplib.IMAP4.abort, socket.error):
+                        throttled = True
+                        raise
+                    finally:
+                        self.controller.release(size, started, throttled)
+            except (imaplib.IMAP4.abort, socket.error):
+                self.close(imap)
+                delay = None if attempt == retry else self.backoff.delay(attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            print("(Reconnect in %.1f sec)" % delay, end=' ', flush=True)
+            self.metrics.count("reconnects")
+            with self.metrics.timer("reconnect"):
+                time.sleep(delay)
+
+    def copy(self, box, appended, google_takeout_box_path = None, retry = None):
+        """Copy messages appended before to another box, with UID COPY.
+
+        appended is (box path, UIDVALIDITY, UID set) as returned by
+        appended_uids().
+        """
+        source_path, uid_validity, uids = appended
+        source = self.mailbox_name(box, source_path)
+
+        def copy(imap, mailbox):
+            # The selected mailbox is shared by the threads using imap.
+            with self.lock:
+                if self.selected != (imap, source):
+                    if imap.examine(source) != uid_validity:
+                        return "NO", [b"UIDVALIDITY of the source box changed"]
+                    self.selected = (imap, source)
+                return imap.uid("COPY", uids, mailbox)
+        return self.send(box, google_takeout_box_path, copy, retry, "copy")
+
+    def fetch_header_fields(self, box, fields, google_takeout_box_path = None, retry = None):
+        """Return the header fields called fields of each message of a box.
+
+        They are fetched fetch_chunk messages at a time, by UID range.
+        """
+        def fetch(imap, mailbox):
+            with self.lock:
+                # copy() must select its source box again.
+                self.selected = None
+                if imap.examine(mailbox) is None:
+                    return []
+                uids = sorted(imap.search_uids(), key=int)
+                headers = []
+                for i in range(0, len(uids), self.fetch_chunk):
+                    chunk = uids[i:i + self.fetch_chunk]
+                    headers.extend(imap.fetch_header_fields(chunk[0] + b":" + chunk[-1], fields))
+                return headers
+        return self.send(box, google_takeout_box_path, fetch, retry, "fetch")
+
+    def mailbox_name(self, box, google_takeout_box_path = None):
+        """Return the quoted, modified UTF-7 name of the destination box."""
+        if google_takeout_box_path is not None:
+            box = self.separator.join(google_takeout_box_path)
+        return imap_utf7.encode('"' + box + '"')
+
+    def supports(self, capability):
+        """Tell whether the server advertises capability."""
+        self.open()
+        return capability in self.imap.capabilities
+
+    def submit(self, key, fn, size=0):
+        """Run fn(self) and return its outcome as a completed Future.
+
+        size is that of the message fn sends, if any.
+        """
+        future = concurrent.futures.Future()
         try:
-            self.open()
-            if type(message) == str:
-                message = message.encode('utf-8', 'surrogateescape').decode('utf-8')
-                message = bytes(message, 'utf-8')
-            if google_takeout_box_path is not None: # Google Takeout
-                self.create_folder(google_takeout_box_path)
-                google_takeout_box = self.separator.join(google_takeout_box_path)
-                google_takeout_box_imap_command = '"' + google_takeout_box + '"'
-                return self.imap.append(imap_utf7.encode(google_takeout_box_imap_command), flags, delivery_time, message)
-            else: # Default behaviour
-                box_imap_command = '"' + box + '"'
-                self.imap_create(imap_utf7.encode(box_imap_command))
-                return self.imap.append(imap_utf7.encode(box_imap_command), flags, delivery_time, message)
-        except (imaplib.IMAP4.abort, socket.error):
-            self.close()
-            if retry == 0:
-                raise
-        print("(Reconnect)", end=' ')
-        time.sleep(5)
-        return self.upload(box, delivery_time, message, flags, google_takeout_box_path, retry - 1)
+            future.set_result(fn(self))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def large_lane(self, size):
+        """Tell whether a message of size bytes is sent on a connection of its own: never here."""
+        return False
 
     def create_folder(self, google_takeout_box_path):
         i = 1
@@ -685,9 +3081,48 @@ class IMAPUploader:
                     print ("Cannot create box %s" % google_takeout_box)
             i += 1
     def imap_create(self, box):
-        if box not in self.created_directories_cache:
-            self.imap.create(box)
-            self.created_directories_cache.append(box)
+        with self.lock:
+            if box not in self.created_directories_cache:
+                self.imap.create(box)
+                self.created_directories_cache.add(box)
+
+    def plan_folders(self, paths):
+        """Create the folders of paths missing on the server, parents first.
+
+        paths are destination boxes, as lists of folder names like
+        google_takeout_box_path or as names. The folders on the server are
+        listed once; after that, send() does no folder work for paths.
+        """
+        folders = set()
+        for path in paths:
+            if isinstance(path, str):
+                path = path.split(self.separator)
+            folders.update(tuple(path[:i]) for i in range(1, len(path) + 1))
+        if all(self.mailbox_name(None, list(path)) in self.created_directories_cache for path in folders):
+            return
+        with self.lock:
+            try:
+                self.open()
+                typ, data = self.imap.list()
+            except (imaplib.IMAP4.abort, socket.error) as e:
+                # send() creates the folders as it goes instead.
+                print("Cannot list the folders: %s" % e)
+                self.close()
+                return
+            existing = listed_names(data) if typ == "OK" else set()
+            missing = [path for path in sorted(folders, key=lambda path: (len(path), path))
+                       if self.separator.join(path) != "INBOX" and
+                       self.mailbox_name(None, list(path))[1:-1] not in existing]
+            if missing:
+                print("Creating {} folders...".format(len(missing)))
+            for path in missing:
+                try:
+                    self.imap.create(self.mailbox_name(None, list(path)))
+                except (imaplib.IMAP4.abort, socket.error):
+                    raise
+                except:
+                    print("Cannot create box %s" % self.separator.join(path))
+            self.created_directories_cache.update(self.mailbox_name(None, list(path)) for path in folders)
 
     def enable_dry_run(self):
         def dummy_create(a):
@@ -698,30 +3133,47 @@ class IMAPUploader:
             print(f"Called append with '{a}'")
             return ("OK", "")
 
+        def dummy_multiappend(a, b):
+            print(f"Called multiappend with '{a}' for {len(b)} messages")
+            return ("OK", "")
+
         self.imap.create = dummy_create
         self.imap.append = dummy_append
+        self.imap.multiappend = dummy_multiappend
 
-    def open(self):
-        if self.imap:
-            return
-        imap_class = [imaplib.IMAP4, imaplib.IMAP4_SSL][self.ssl]
-        self.imap = imap_class(self.host, self.port)
-        if self.dry_run:
-            self.enable_dry_run()
-        self.imap.socket().settimeout(60)
-        self.imap.login(self.user, self.password)
-        self.created_directories_cache = []
+    def connect(self):
+        imap_class = [IMAP4, IMAP4_SSL][self.ssl]
+        imap = imap_class(self.host, self.port)
+        imap.socket().settimeout(60)
+        # Commands and literals are sent in several writes; do not let
+        # Nagle's algorithm hold the last one back until the server acks.
+        imap.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return imap
 
-        try:
-            self.imap_create(self.box)
-        except Exception as e:
-            print("(create error: )" + str(e))
-
-    def close(self):
-        if not self.imap:
-            return
-        self.imap.shutdown()
-        self.imap = None
+    def open(self):
+        with self.lock:
+            if self.imap:
+                return
+            self.imap = self.connect()
+            if self.dry_run:
+                self.enable_dry_run()
+            self.imap.login(self.user, self.password)
+            self.append_limit = append_limit(self.imap.capabilities, self.host)
+            if self.compress and "COMPRESS=DEFLATE" in self.imap.capabilities:
+                self.imap.compress(self.compression)
+
+            try:
+                self.imap_create(self.box)
+            except Exception as e:
+                print("(create error: )" + str(e))
+
+    def close(self, imap=None):
+        """Close the connection, or only imap if it is still the current one."""
+        with self.lock:
+            if not self.imap or (imap is not None and imap is not self.imap):
+                return
+            self.imap.shutdown()
+            self.imap = None
 
     def list_boxes(self):
         try:
@@ -732,6 +3184,440 @@ class IMAPUploader:
             self.close()
 
 
+class AsyncIMAP4:
+    """A small IMAP4 client running on an asyncio event loop.
+
+    It offers the blocking methods of imaplib.IMAP4 that IMAPUploader uses
+    and may be called from several threads at once. Commands are written
+    to the socket as soon as they are issued, without waiting for the
+    tagged responses of the previous ones, and responses are matched to
+    their command by tag: with N threads calling append(), N APPENDs are
+    in flight on the one connection.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+    literal_re = re.compile(br"\{(\d+)\}$")
+
+    def __init__(self, host, port, use_ssl=False, timeout=60):
+        self.timeout = timeout
+        self.tagpre = imaplib.Int2AP(random.randint(4096, 65535))
+        self.tagnum = 0
+        self.tagged = {}
+        self.untagged = {}
+        self.continuation = None
+        self.broken = None
+        self.writer = None
+        self.codec = None
+        self.starting_compression = None
+        self.capabilities = ()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        try:
+            self.run(self.connect(host, port, use_ssl))
+        except:
+            self.shutdown()
+            raise
+
+    def run(self, coroutine):
+        """Run coroutine on the event loop and wait for its result."""
+        if self.loop.is_closed():
+            coroutine.close()
+            raise self.abort("socket error: connection closed")
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        while not future.done():
+            concurrent.futures.wait([future], 1)
+            if not future.done() and not self.loop.is_running():
+                future.cancel()
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise self.abort("socket error: connection closed")
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+
+    async def connect(self, host, port, use_ssl):
+        context = ssl._create_stdlib_context() if use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), self.timeout)
+        self.write_lock = asyncio.Lock()
+        greeting = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not greeting.startswith((b"* OK", b"* PREAUTH")):
+            raise self.abort("unexpected greeting: %r" % greeting)
+        self.reading = self.loop.create_task(self.read_responses())
+        await self.get_capabilities()
+
+    async def get_capabilities(self):
+        await self.command("CAPABILITY")
+        capabilities = self.untagged.pop("CAPABILITY", [b""])[-1]
+        self.capabilities = tuple(capabilities.decode("ascii", "replace").upper().split())
+
+    def encode_arguments(self, args):
+        return [arg if isinstance(arg, bytes) else arg.encode("ascii") for arg in args if arg is not None]
+
+    async def command(self, name, *args, literals=()):
+        """Send a command and wait for its tagged response.
+
+        literals is a list of (literal, arguments) pairs: each literal goes
+        after the arguments before it, and is followed by its arguments.
+        Literals are sent without waiting for the server when it allows it.
+        """
+        limit = non_synchronizing_limit(self.capabilities)
+        async with self.write_lock:
+            if self.broken:
+                raise self.broken
+            self.tagnum += 1
+            tag = b"%s%d" % (self.tagpre, self.tagnum)
+            completion = self.loop.create_future()
+            self.tagged[tag] = completion
+            line = b" ".join([tag, name.encode("ascii")] + self.encode_arguments(args))
+            for literal, more in literals:
+                if len(literal) <= limit:
+                    self.write(line + b" {%d+}" % len(literal) + imaplib.CRLF)
+                    await self.write_literal(literal)
+                    line = b"".join(b" " + arg for arg in self.encode_arguments(more))
+                    continue
+                # Only one command at a time can wait for its continuation,
+                # hence the write lock is held until the literals are sent.
+                self.continuation = self.loop.create_future()
+                self.write(line + b" {%d}" % len(literal) + imaplib.CRLF)
+                await asyncio.wait([self.continuation, completion], return_when=asyncio.FIRST_COMPLETED)
+                if completion.done():
+                    break
+                self.continuation.result()
+                await self.write_literal(literal)
+                line = b"".join(b" " + arg for arg in self.encode_arguments(more))
+            else:
+                self.write(line + imaplib.CRLF)
+            self.continuation = None
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        typ, data = await completion
+        if typ == "BAD":
+            raise self.error("%s command error: %s %s" % (name, typ, data))
+        return typ, data
+
+    async def read_line(self):
+        """Read a response line, and the literals it announces."""
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                if self.tagged:
+                    raise self.abort("socket error: timed out")
+        if not line:
+            raise self.abort("socket error: EOF")
+        line = line.rstrip(b"\r\n")
+        m = self.literal_re.search(line)
+        while m:
+            literal = await self.reader.readexactly(int(m.group(1)))
+            rest = (await self.reader.readline()).rstrip(b"\r\n")
+            line = line + imaplib.CRLF + literal + rest
+            m = self.literal_re.search(rest)
+        return line
+
+    async def read_responses(self):
+        try:
+            while True:
+                line = await self.read_line()
+                if line.startswith(b"+"):
+                    if self.continuation is not None and not self.continuation.done():
+                        self.continuation.set_result(line)
+                elif line.startswith(b"* "):
+                    words = line[2:].split(b" ", 2)
+                    if words[0].isdigit() and len(words) > 1:
+                        name, data = words[1], b" ".join([words[0]] + words[2:])
+                    else:
+                        name, data = words[0], b" ".join(words[1:])
+                    name = name.decode("ascii", "replace").upper()
+                    # These come with each APPEND to the selected mailbox
+                    # and are never read: do not let them pile up.
+                    if name not in ("EXISTS", "RECENT", "EXPUNGE"):
+                        self.untagged.setdefault(name, []).append(data)
+                else:
+                    tag, typ, text = (line.split(b" ", 2) + [b"", b""])[:3]
+                    completion = self.tagged.pop(tag, None)
+                    if completion is not None and not completion.done():
+                        completion.set_result((typ.decode("ascii", "replace").upper(), [text]))
+                    if self.starting_compression is not None:
+                        # Nothing else is in flight during COMPRESS: this is
+                        # its response, and the server deflates from now on.
+                        if typ.upper() == b"OK":
+                            self.reader = AsyncDeflateReader(self.reader, self.starting_compression)
+                        self.starting_compression = None
+        except (Exception, asyncio.CancelledError) as e:
+            self.fail(e)
+
+    def fail(self, e):
+        """Fail every command in flight: the connection is unusable."""
+        if not isinstance(e, self.abort):
+            e = self.abort("socket error: %s" % (str(e) or type(e).__name__))
+        self.broken = e
+        for completion in self.tagged.values():
+            if not completion.done():
+                completion.set_exception(e)
+        self.tagged.clear()
+        if self.continuation is not None and not self.continuation.done():
+            self.continuation.set_exception(e)
+
+    def write(self, data):
+        if self.codec is not None:
+            data = self.codec.compress(data)
+        self.writer.write(data)
+
+    async def write_literal(self, literal):
+        if isinstance(literal, bytes):
+            self.write(literal)
+            return
+        # Each piece is sent before the next one is read.
+        for piece in literal.pieces():
+            self.write(piece)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    def compress(self, stats):
+        """Compress the rest of the session with DEFLATE (RFC 4978).
+
+        Must not be called while other commands are in flight.
+        """
+        return self.run(self.start_compression(DeflateCodec(stats)))
+
+    async def start_compression(self, codec):
+        self.starting_compression = codec
+        typ, data = await self.command("COMPRESS", "DEFLATE")
+        if typ == "OK":
+            self.codec = codec
+        return typ, data
+
+    def quote(self, arg):
+        return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def login(self, user, password):
+        typ, data = self.run(self.command("LOGIN", self.quote(user), self.quote(password)))
+        if typ != "OK":
+            raise self.error(data[-1])
+        # Servers may advertise more capabilities once logged in.
+        self.run(self.get_capabilities())
+        return typ, data
+
+    def create(self, mailbox):
+        return self.run(self.command("CREATE", mailbox))
+
+    def list(self, directory='""', pattern='*'):
+        typ, data = self.run(self.command("LIST", directory, pattern))
+        return typ, self.untagged.pop("LIST", [None])
+
+    def append(self, mailbox, flags, date_time, message):
+        flags, date_time, literal = append_arguments(flags, date_time, message)
+        return self.run(self.command("APPEND", mailbox, flags, date_time, literals=[(literal, [])]))
+
+    def examine(self, mailbox):
+        """Select mailbox read-only and return its UIDVALIDITY, or None."""
+        self.untagged.pop("OK", None)
+        typ, data = self.run(self.command("EXAMINE", mailbox))
+        if typ != "OK":
+            return None
+        for line in self.untagged.pop("OK", []):
+            m = re.match(br"\[UIDVALIDITY (\d+)\]", line)
+            if m:
+                return m.group(1)
+        return None
+
+    def uid(self, command, *args):
+        return self.run(self.command("UID", command, *args))
+
+    def search_uids(self):
+        """Return the UIDs of the messages of the selected mailbox."""
+        self.untagged.pop("SEARCH", None)
+        typ, data = self.uid("SEARCH", "ALL")
+        if typ != "OK":
+            raise self.error(data[-1])
+        return b" ".join(self.untagged.pop("SEARCH", [])).split()
+
+    def fetch_header_fields(self, uids, fields):
+        """Return the header fields called fields of the messages of a UID set."""
+        self.untagged.pop("FETCH", None)
+        typ, data = self.uid("FETCH", uids, "(BODY.PEEK[HEADER.FIELDS (%s)])" % " ".join(fields))
+        if typ != "OK":
+            raise self.error(data[-1])
+        headers = []
+        for line in self.untagged.pop("FETCH", []):
+            # read_line() has put the literal after the CRLF ending its size.
+            head, crlf, literal = line.partition(imaplib.CRLF)
+            m = self.literal_re.search(head)
+            if m:
+                headers.append(literal[:int(m.group(1))])
+        return headers
+
+    def multiappend(self, mailbox, messages):
+        """Append messages to mailbox with a single command (RFC 3502)."""
+        arguments = [append_arguments(*message) for message in messages]
+        literals = [(literal, next_arguments[:2]) for (flags, date_time, literal), next_arguments
+                    in zip(arguments, arguments[1:] + [(None, None, None)])]
+        flags, date_time, literal = arguments[0]
+        return self.run(self.command("APPEND", mailbox, flags, date_time, literals=literals))
+
+    def shutdown(self):
+        if self.loop.is_closed():
+            return
+        async def close():
+            self.fail(self.abort("socket error: connection closed"))
+            if self.writer is not None:
+                self.writer.close()
+            # Let the commands in flight see that they failed.
+            await asyncio.sleep(0)
+        try:
+            self.run(close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+class AsyncIMAPUploader(IMAPUploader):
+    """IMAPUploader over an AsyncIMAP4 connection.
+
+    upload() may be called from several threads at once, each call keeping
+    one APPEND in flight on the shared connection.
+    """
+
+    def connect(self):
+        return AsyncIMAP4(self.host, self.port, self.ssl, timeout=60)
+
+
+class WorkQueue:
+    """A bounded FIFO queue of work, with a second one for large messages.
+
+    Large items are only taken by get(large=True), before the other items;
+    either queue holds up to maxsize items.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.large_items = collections.deque()
+        self.changed = threading.Condition()
+
+    def put(self, item, large=False):
+        items = self.large_items if large else self.items
+        with self.changed:
+            while len(items) >= self.maxsize:
+                self.changed.wait()
+            items.append(item)
+            self.changed.notify_all()
+
+    def get(self, large=False):
+        with self.changed:
+            while not (self.items or (large and self.large_items)):
+                self.changed.wait()
+            item = self.large_items.popleft() if large and self.large_items else self.items.popleft()
+            self.changed.notify_all()
+            return item
+
+
+class IMAPUploaderPool:
+    """Share the uploads between several IMAPUploader connections.
+
+    Each connection runs in its own thread and takes its work from a
+    bounded queue, so that several APPENDs are in flight at once. When
+    ordered is set, all the work submitted with the same key (the
+    destination box) goes through the same connection and is therefore
+    appended in submission order. Otherwise, with several connections,
+    messages of large_size bytes or more are all sent over the last one,
+    so that the others keep up the stream of smaller messages meanwhile.
+    """
+
+    large_size = 1024 * 1024
+
+    def __init__(self, uploaders, ordered=False, queue_size=None):
+        self.uploaders = uploaders
+        self.ordered = ordered
+        if queue_size is None:
+            queue_size = 4 * len(uploaders)
+        if ordered:
+            self.queues = [WorkQueue(max(1, queue_size // len(uploaders))) for uploader in uploaders]
+        else:
+            self.queues = [WorkQueue(queue_size)] * len(uploaders)
+        self.window = queue_size + len(uploaders)
+        connections = list(dict.fromkeys(uploaders))
+        self.lane = connections[-1] if not ordered and len(connections) > 1 else None
+        # A folder created by one connection need not be by the others.
+        for uploader in uploaders:
+            uploader.created_directories_cache = uploaders[0].created_directories_cache
+        self.threads = []
+        for uploader, work in zip(uploaders, self.queues):
+            thread = threading.Thread(target=self.work, args=(uploader, work, uploader is self.lane), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, uploader, work, large=False):
+        while True:
+            item = work.get(large)
+            if item is None:
+                return
+            future, fn = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(uploader))
+            except Exception as e:
+                future.set_exception(e)
+
+    def submit(self, key, fn, size=0):
+        """Queue fn to be run on one of the connections; return a Future.
+
+        size is that of the message fn sends, if any.
+        """
+        future = concurrent.futures.Future()
+        if self.ordered:
+            work = self.queues[hash(key) % len(self.queues)]
+        else:
+            work = self.queues[0]
+        work.put((future, fn), self.large_lane(size))
+        return future
+
+    def large_lane(self, size):
+        """Tell whether a message of size bytes is sent over the connection kept for large ones."""
+        return self.lane is not None and size >= self.large_size
+
+    def open(self):
+        self.uploaders[0].open()
+
+    def supports(self, capability):
+        return self.uploaders[0].supports(capability)
+
+    @property
+    def metrics(self):
+        return self.uploaders[0].metrics
+
+    @property
+    def append_limit(self):
+        return self.uploaders[0].append_limit
+
+    @property
+    def compression(self):
+        compression = CompressionStats()
+        for uploader in set(self.uploaders):
+            compression.add(uploader.compression)
+        return compression
+
+    def list_boxes(self):
+        return self.uploaders[0].list_boxes()
+
+    def plan_folders(self, paths):
+        # On one of the connections, which may be busy with other uploads.
+        paths = list(paths)
+        self.submit(None, lambda uploader: uploader.plan_folders(paths)).result()
+
+    def close(self):
+        for work in self.queues:
+            work.put(None)
+        for thread in self.threads:
+            thread.join()
+        for uploader in self.uploaders:
+            uploader.close()
+
+
 def main(args=None):
     try:
         # Setup locale
@@ -757,6 +3643,13 @@ def main(args=None):
         list_boxes = options.pop("list_boxes")
         err = options.pop("error")
         time_fields = options.pop("time_fields")
+        options["backoff"] = Backoff(budget=options.pop("reconnect_budget"))
+        adaptive = options.pop("adaptive")
+        daily_bytes = options.pop("daily_bytes")
+        stream_size = options.pop("stream_size")
+        resume = options.pop("resume")
+        skip_existing = options.pop("skip_existing")
+        replay_errors = options.pop("replay_errors")
 
         recurse = options.pop("r")
         email_only_folders = options.pop("email_only_folders")
@@ -767,6 +3660,17 @@ def main(args=None):
         google_takeout_first_label = options.pop("google_takeout_first_label")
         google_takeout_label_priority = options.pop("google_takeout_label_priority").split(",")
         google_takeout_language = options.pop("google_takeout_language")
+        connections = options.pop("connections")
+        pipeline = options.pop("pipeline")
+        batch_size = options.pop("batch_size")
+        batch_bytes = options.pop("batch_bytes")
+        mailboxes = options.pop("mailboxes")
+        parse_workers = options.pop("parse_workers")
+        keep_order = options.pop("keep_order")
+        metrics_path = options.pop("metrics")
+        metrics_format = options.pop("metrics_format")
+        metrics_interval = options.pop("metrics_interval")
+        quiet = options.pop("quiet")
         debug = options.pop("debug")
 
 
@@ -783,20 +3687,44 @@ def main(args=None):
             pretty_print_mailboxes(uploader.list_boxes())
         else:
             src = options.pop("src")
+            metrics = options["metrics"] = Metrics()
+            if adaptive or daily_bytes:
+                options["controller"] = RateController(connections * pipeline, daily_bytes, adaptive, metrics)
 
-            uploader = IMAPUploader(**options)
+            uploader_class = AsyncIMAPUploader if pipeline > 1 else IMAPUploader
+            uploader = uploader_class(**options)
             uploader.open()
             if debug: print("Connection successful")
-
-            if(not recurse):
-                # Prepare source and error mbox
-                src = mailbox.mbox(src, create=False)
+            if connections > 1 or pipeline > 1 or (recurse and mailboxes > 1):
+                uploaders = [uploader] + [uploader_class(**options) for i in range(connections - 1)]
+                # A pipelining connection is shared by pipeline threads,
+                # each of them keeping one APPEND in flight.
+                uploader = IMAPUploaderPool([u for u in uploaders for i in range(pipeline)], keep_order)
+
+            if metrics_path:
+                writer = MetricsWriter(metrics, metrics_path, metrics_format, metrics_interval)
+                writer.start()
+            try:
                 if err:
-                    err = mailbox.mbox(err)
-                upload(uploader, options["box"], src, err, time_fields, google_takeout, google_takeout_first_label,
-                       google_takeout_label_priority, google_takeout_box_as_base_folder, google_takeout_language, debug, maximum_size_exceeded_are_warnings)
-            else:
-                recursive_upload(uploader, "", src, err, time_fields, email_only_folders, separator, debug)
+                    err = ErrorMbox(err)
+                if(not recurse):
+                    # Prepare source
+                    targets = ErrorMbox.targets(src) if replay_errors else None
+                    src = open_mbox(src, stream_size)
+                    upload(uploader, options["box"], src, err, time_fields, google_takeout, google_takeout_first_label,
+                           google_takeout_label_priority, google_takeout_box_as_base_folder, google_takeout_language, debug, maximum_size_exceeded_are_warnings,
+                           batch_size, batch_bytes, resume, skip_existing, metrics, quiet, parse_workers=parse_workers,
+                           targets=targets)
+                else:
+                    recursive_upload(uploader, "", src, err, time_fields, email_only_folders, separator, debug, resume,
+                                     skip_existing, metrics, quiet, mailboxes, stream_size, google_takeout,
+                                     google_takeout_first_label, google_takeout_label_priority,
+                                     google_takeout_box_as_base_folder, google_takeout_language,
+                                     maximum_size_exceeded_are_warnings, batch_size, batch_bytes, parse_workers)
+            finally:
+                if metrics_path:
+                    writer.close()
+            uploader.close()
 
         return 0
 
@@ -806,6 +3734,12 @@ def main(args=None):
     except mailbox.NoSuchMailboxError as e:
         print("No such mailbox:", e)
         return 1
+    except mailbox.FormatError as e:
+        print("Cannot read mailbox:", e)
+        return 1
+    except ImportError as e:
+        print(e)
+        return 1
     except socket.timeout as e:
         print("Timed out")
         return 1
@@ -817,7 +3751,7 @@ def main(args=None):
         return 130
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
-        print("An unknown error has occurred [{}]: {}".format(exc_tb.tb_lineno), e)
+        print("An unknown error has occurred [{}]: {}".format(exc_tb.tb_lineno, e))
         return 1
 
 